@@ -1,3 +1,20 @@
-from .connection import get_connection, start_transaction, configure, close
-from .model import Model
+from .connection import (
+    get_connection,
+    connection_scope,
+    start_transaction,
+    configure,
+    close,
+    PoolOptions,
+    ReplicaSelection,
+    on_connect,
+    prepare_on_connect,
+)
+from .model import Model, BatchProgress
+from .batch import batch
+from .parallel import parallel
+from .buffered_writer import BufferedWriter
+from .retry import RetryPolicy, RetryEvent, retry_transaction, add_retry_listener, remove_retry_listener
 from .indexes import Index, UniqueIndex
+from .pool_metrics import configure_pool_metrics, pool_stats, add_pool_listener, remove_pool_listener
+from .instrumentation import add_query_listener, remove_query_listener, QueryEvent, QueryLogWriter, OpenTelemetryListener
+from .slow_query_log import SlowQueryLog, SlowQuery
@@ -0,0 +1,79 @@
+from typing import Any, List
+from asyncpg import Connection
+from time import perf_counter, time_ns
+from .connection import get_connection
+from . import sharding, instrumentation
+from .query_builder.query_builder import (
+    QueryBuilder,
+    QueryType,
+    convert_named_to_positional,
+    fetch,
+    get_parameter_names,
+)
+from .query_builder.conditions import get_in_list_tables
+
+
+def batch_sql(queries: List[QueryBuilder]):
+    # Every query becomes one array column of a single row. Selecting the
+    # derived table's row gives an array of anonymous records that asyncpg
+    # decodes into tuples with their column types intact, which json_agg
+    # would lose.
+    parameters = {}
+    columns_sql = []
+    for i, query in enumerate(queries):
+        if query.query_type != QueryType.SELECT:
+            raise Exception("batch() can only run selects")
+        if query.shard_name is None and sharding.get_shard_key(query.return_as_cls) is not None:
+            raise Exception("batch() can't route queries of sharded models, run them with run()")
+        query_sql, query_parameters = query.named_sql()
+        columns_sql.append(f"ARRAY(SELECT batch_{i} FROM ({query_sql}) batch_{i}) AS result_{i}")
+        parameters.update(query_parameters)
+    return f"SELECT {", ".join(columns_sql)}", parameters
+
+
+async def batch(*queries: QueryBuilder, conn: Connection | None = None) -> List[List[Any]]:
+    # Runs independent selects as a single statement, one round trip on one
+    # connection, and returns the hydrated results of each query in order.
+    # asyncpg has no pipelining, so the queries are combined server side.
+    if len(queries) == 0:
+        return []
+    started_at = time_ns()
+    start = perf_counter()
+    named_sql, named_params = batch_sql(list(queries))
+    sql, params = convert_named_to_positional(named_sql, named_params)
+    in_list_tables = get_in_list_tables(named_params)
+    # A hot standby can't create the temp tables of long in_() lists
+    readonly = all(query.is_readonly() for query in queries) and len(in_list_tables) == 0
+    shards = {query.shard_name for query in queries}
+    if len(shards) > 1:
+        raise Exception("batch() queries have to run on the same shard")
+    shard = shards.pop()
+
+    compiled = perf_counter()
+    async with get_connection(conn, readonly=readonly, shard=shard) as conn:
+        acquired = perf_counter()
+        [row] = await fetch(conn, sql, params, in_list_tables)
+        executed = perf_counter()
+    results = [query.hydrate_tuples(row[i]) for i, query in enumerate(queries)]
+    hydrated_at = perf_counter()
+
+    if len(instrumentation.listeners) > 0:
+        instrumentation.emit(
+            instrumentation.QueryEvent(
+                fingerprint=instrumentation.fingerprint(sql),
+                sql=sql,
+                table=None,
+                model=None,
+                query_type="batch",
+                parameters=params,
+                parameter_names=get_parameter_names(named_sql),
+                shard=shard,
+                row_count=sum(len(result) for result in results),
+                started_at=started_at,
+                compile_time=compiled - start,
+                acquire_time=acquired - compiled,
+                execute_time=executed - acquired,
+                hydrate_time=hydrated_at - executed,
+            )
+        )
+    return results
@@ -0,0 +1,105 @@
+from typing import Any, Dict, Generic, List, Set, Tuple, TypeVar
+import asyncio
+from weakref import WeakSet
+from . import connection
+
+T = TypeVar("T")
+
+# Postgres accepts at most this many parameters in one statement
+MAX_PARAMETERS = 32767
+
+# Writers that are still open, actual_orm.close() flushes them
+writers: "WeakSet[BufferedWriter]" = WeakSet()
+
+
+class BufferedWriter(Generic[T]):
+    # Collects create() calls and inserts them with one multi-row INSERT once
+    # max_rows are buffered or the oldest row waited max_latency_ms. Every
+    # caller gets its own returned row. create() waits while max_pending rows
+    # are buffered or being written.
+    def __init__(self, model: Any, max_rows: int = 1000, max_latency_ms: float = 5, max_pending: int | None = None):
+        self.model = model
+        self.max_rows = max_rows
+        self.max_latency = max_latency_ms / 1000
+        self.slots = asyncio.Semaphore(max_pending or max_rows * 4)
+        self.rows: List[Tuple[Dict[str, Any], asyncio.Future]] = []
+        self.timer: asyncio.TimerHandle | None = None
+        self.flushes: Set[asyncio.Task] = set()
+        self.closed = False
+        self.loop: asyncio.AbstractEventLoop | None = None
+        writers.add(self)
+
+    async def create(self, data: Any) -> T:
+        if self.closed:
+            raise Exception(f"BufferedWriter of {self.model.__name__} is closed")
+        async with self.slots:
+            self.loop = asyncio.get_running_loop()
+            future = self.loop.create_future()
+            self.rows.append((dict(data), future))
+            if len(self.rows) >= self.max_rows:
+                self.start_flush()
+            elif self.timer is None:
+                self.timer = self.loop.call_later(self.max_latency, self.start_flush)
+            return await future
+
+    def start_flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if len(self.rows) == 0:
+            return
+        rows, self.rows = self.rows, []
+        task = asyncio.get_running_loop().create_task(self.write(rows))
+        self.flushes.add(task)
+        task.add_done_callback(self.flushes.discard)
+
+    async def write(self, rows: List[Tuple[Dict[str, Any], asyncio.Future]]):
+        # The flush isn't part of whatever scope or transaction the caller that
+        # filled the buffer happened to be in
+        connection.current_connection.set(None)
+        connection.current_shard.set(None)
+
+        # A multi-row INSERT needs the same columns in every row
+        groups: Dict[Tuple[str, ...], List[Tuple[Dict[str, Any], asyncio.Future]]] = {}
+        for row in rows:
+            groups.setdefault(tuple(row[0].keys()), []).append(row)
+
+        for columns, group in groups.items():
+            chunk_size = max(1, MAX_PARAMETERS // max(1, len(columns)))
+            for start in range(0, len(group), chunk_size):
+                await self.write_chunk(group[start : start + chunk_size])
+
+    async def write_chunk(self, chunk: List[Tuple[Dict[str, Any], asyncio.Future]]):
+        try:
+            results = await self.model.create_many([data for data, _ in chunk])
+        except Exception as e:
+            if len(chunk) == 1:
+                _, future = chunk[0]
+                if not future.done():
+                    future.set_exception(e)
+                return
+            # One bad row fails the whole insert, inserting the rows one by
+            # one gives every caller its own row or its own error
+            for row in chunk:
+                await self.write_chunk([row])
+            return
+        for (_, future), result in zip(chunk, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def flush(self):
+        self.start_flush()
+        if len(self.flushes) > 0:
+            await asyncio.gather(*self.flushes, return_exceptions=True)
+
+    async def close(self):
+        self.closed = True
+        await self.flush()
+        writers.discard(self)
+
+
+async def close_writers():
+    loop = asyncio.get_running_loop()
+    for writer in list(writers):
+        if writer.loop is None or writer.loop is loop:
+            await writer.close()
@@ -0,0 +1,74 @@
+import click
+from typing import Dict, List
+from ..utils.get_database_url import get_database_url
+from ..utils.get_models import get_models
+from ..utils.model_schema import get_models_schema, get_table_name
+from ..utils.database_schema import get_database_schema
+from ..utils.index_advisor import (
+    WorkloadQuery,
+    load_query_log,
+    load_pg_stat_statements,
+    suggest_indexes,
+    find_redundant_indexes,
+    find_unused_indexes,
+    get_model_diff,
+)
+
+async def advise_indexes_command(log: str | None, pg_stat_statements: bool, min_calls: int, apply: bool):
+    database_url = get_database_url()
+
+    if database_url == None:
+        raise Exception("DATABASE_URL is not defined in .env")
+
+    if log == None and pg_stat_statements == False:
+        raise click.UsageError("Provide a query log with --log or use --pg-stat-statements")
+
+    workload: List[WorkloadQuery] = []
+    if log != None:
+        workload += load_query_log(log)
+    if pg_stat_statements:
+        workload += await load_pg_stat_statements(database_url)
+
+    model_tables, _ = get_models_schema()
+    database_tables, _ = await get_database_schema(database_url)
+
+    suggestions = suggest_indexes(workload, model_tables + database_tables, min_calls=min_calls)
+    models = {get_table_name(model): model for model in get_models()}
+
+    if len(suggestions) == 0:
+        click.echo("No missing indexes found")
+    else:
+        click.echo("Suggested indexes:")
+        for suggestion in suggestions:
+            click.echo(
+                f"  {suggestion.table} ({", ".join(suggestion.columns)}): "
+                f"{suggestion.calls} calls, {suggestion.total_time:.3f}s total"
+            )
+
+        indexes_by_table: Dict[str, List[List[str]]] = {}
+        for suggestion in suggestions:
+            if suggestion.table in models:
+                indexes_by_table.setdefault(suggestion.table, []).append(suggestion.columns)
+
+        click.echo("")
+        for table, indexes in indexes_by_table.items():
+            path, new_source, diff = get_model_diff(models[table], indexes)
+            click.echo(diff)
+            if apply:
+                with open(path, "w") as file:
+                    file.write(new_source)
+
+        if apply:
+            click.echo("Model files updated, run `actual migrate dev` to create the indexes")
+
+    redundant = find_redundant_indexes(model_tables)
+    if len(redundant) > 0:
+        click.echo("Redundant indexes:")
+        for finding in redundant:
+            click.echo(f"  {finding.table}.{finding.name} ({", ".join(finding.columns)}): {finding.reason}")
+
+    unused = await find_unused_indexes(database_url)
+    if len(unused) > 0:
+        click.echo("Unused indexes:")
+        for finding in unused:
+            click.echo(f"  {finding.table}.{finding.name}: {finding.reason}")
@@ -3,7 +3,7 @@ from ..utils.get_database_url import get_database_url
 from ..utils.get_models import get_models
 from ..utils.model_schema import get_models_schema
 from ..utils.database_schema import get_database_schema
-from ..utils.schema_differ import get_schema_diff_actions
+from ..utils.schema_differ import get_schema_diff_actions, get_unindexed_foreign_keys
 from ..utils.action import action_to_sql
 from ..utils.write_migration import write_migration
 from ..utils.run_migrations import run_migrations
@@ -19,6 +19,12 @@ async def migrate_dev_command():
     database_schema = await get_database_schema(database_url)
     model_schema = get_models_schema()
 
+    unindexed_foreign_keys = get_unindexed_foreign_keys(database_schema[0])
+    if len(unindexed_foreign_keys) > 0:
+        click.echo("Foreign key columns without an index:")
+        for table, column in unindexed_foreign_keys:
+            click.echo(f"  {table.name}.{column.name}")
+
     actions = get_schema_diff_actions(model_schema=model_schema, database_schema=database_schema)
 
     if len(actions) == 0:
@@ -5,6 +5,7 @@ from .commands.migrate_dev import migrate_dev_command
 from .commands.migrate_prod import migrate_prod_command
 from .commands.migrate_create import migrate_create_command
 from .commands.migrate_reset import migrate_reset_command
+from .commands.advise_indexes import advise_indexes_command
 
 @click.group()
 def main():
@@ -34,5 +35,17 @@ def create():
 def reset():
     asyncio.run(migrate_reset_command())
 
+@main.group()
+def advise():
+    pass
+
+@advise.command()
+@click.option("--log", type=click.Path(exists=True), help="Query log written by QueryLogWriter")
+@click.option("--pg-stat-statements", is_flag=True, help="Read the workload from pg_stat_statements")
+@click.option("--min-calls", type=int, default=1, help="Ignore queries that ran fewer times")
+@click.option("--apply", is_flag=True, help="Write the suggested indexes into the model files")
+def indexes(log, pg_stat_statements, min_calls, apply):
+    asyncio.run(advise_indexes_command(log, pg_stat_statements, min_calls, apply))
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
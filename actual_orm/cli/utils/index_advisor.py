@@ -0,0 +1,357 @@
+from typing import Dict, List, Tuple, Type, Iterable
+from dataclasses import dataclass, field
+import difflib
+import inspect
+import json
+import os
+import re
+import asyncpg
+from .schema import Table, UniqueConstraint
+from ...model import Model
+
+PREDICATE_PATTERN = re.compile(
+    r"(?:(\w+)\.)?(\w+)\s*(=\s*ANY\b|=|<>|!=|<=|>=|<|>|\bNOT\s+LIKE\b|\bLIKE\b|\bILIKE\b|\bIS\b|\bIN\b|\bBETWEEN\b)",
+    re.IGNORECASE,
+)
+JOIN_PATTERN = re.compile(r"(\w+)\.(\w+)\s*=\s*(\w+)\.(\w+)")
+TABLE_PATTERN = re.compile(r"\b(?:FROM|JOIN|UPDATE|INTO)\s+(\w+)", re.IGNORECASE)
+ON_PATTERN = re.compile(
+    r"\bON\b(.*?)(?=\b(?:JOIN|WHERE|ORDER\s+BY|LIMIT|GROUP\s+BY|RETURNING)\b|$)",
+    re.IGNORECASE | re.DOTALL,
+)
+WHERE_PATTERN = re.compile(
+    r"\bWHERE\b(.*?)(?=\b(?:ORDER\s+BY|LIMIT|GROUP\s+BY|RETURNING|FOR\s+UPDATE|FOR\s+SHARE)\b|$)",
+    re.IGNORECASE | re.DOTALL,
+)
+ORDER_BY_PATTERN = re.compile(
+    r"\bORDER\s+BY\b(.*?)(?=\b(?:LIMIT|OFFSET|FOR|RETURNING)\b|$)", re.IGNORECASE | re.DOTALL
+)
+KEYWORDS = {"and", "or", "not", "null", "true", "false", "any", "all", "exists", "select"}
+EQUALITY_OPERATORS = {"=", "= any", "in", "is"}
+
+
+@dataclass
+class WorkloadQuery:
+    sql: str
+    calls: int
+    total_time: float
+
+
+@dataclass
+class TableAccess:
+    # Columns of one table a query filters, joins or orders on
+    table: str
+    equality: List[str] = field(default_factory=list)
+    range: List[str] = field(default_factory=list)
+    order_by: List[str] = field(default_factory=list)
+
+    def candidate(self) -> List[str]:
+        # Equality columns first, then a single range column or the sort order
+        columns = list(self.equality)
+        if len(self.range) > 0:
+            columns.append(self.range[0])
+        else:
+            columns += [column for column in self.order_by if column not in columns]
+        return columns
+
+
+@dataclass
+class IndexSuggestion:
+    table: str
+    columns: List[str]
+    calls: int
+    total_time: float
+    queries: List[str]
+
+
+@dataclass
+class IndexFinding:
+    table: str
+    name: str
+    columns: List[str]
+    reason: str
+
+
+def add_column(columns: List[str], column: str):
+    if column not in columns:
+        columns.append(column)
+
+
+def parse_query(sql: str) -> Dict[str, TableAccess]:
+    tables = [table for table in TABLE_PATTERN.findall(sql) if table.lower() != "select"]
+    if len(tables) == 0:
+        return {}
+    base_table = tables[0]
+    accesses: Dict[str, TableAccess] = {}
+
+    def access(table: str | None) -> TableAccess | None:
+        table = table or base_table
+        if table not in tables:
+            return None
+        if table not in accesses:
+            accesses[table] = TableAccess(table=table)
+        return accesses[table]
+
+    predicates = " ".join(ON_PATTERN.findall(sql) + WHERE_PATTERN.findall(sql))
+    for left_table, left_column, right_table, right_column in JOIN_PATTERN.findall(predicates):
+        for table, column in ((left_table, left_column), (right_table, right_column)):
+            table_access = access(table)
+            if table_access is not None:
+                add_column(table_access.equality, column)
+    predicates = JOIN_PATTERN.sub("", predicates)
+
+    for table, column, operator in PREDICATE_PATTERN.findall(predicates):
+        if column.lower() in KEYWORDS or column.isdigit():
+            continue
+        table_access = access(table or None)
+        if table_access is None:
+            continue
+        operator = re.sub(r"\s+", " ", operator.lower())
+        if operator in EQUALITY_OPERATORS:
+            add_column(table_access.equality, column)
+        elif operator not in ("<>", "!=", "not like"):
+            add_column(table_access.range, column)
+
+    for order_by in ORDER_BY_PATTERN.findall(sql):
+        for expression in order_by.split(","):
+            match = re.match(r"\s*(?:(\w+)\.)?(\w+)", expression)
+            if match is None:
+                continue
+            table_access = access(match.group(1))
+            if table_access is not None:
+                add_column(table_access.order_by, match.group(2))
+
+    return accesses
+
+
+def load_query_log(path: str) -> List[WorkloadQuery]:
+    # Reads the JSON lines written by instrumentation.QueryLogWriter
+    queries: Dict[str, WorkloadQuery] = {}
+    with open(path) as file:
+        for line in file:
+            if line.strip() == "":
+                continue
+            event = json.loads(line)
+            query = queries.setdefault(
+                event["fingerprint"], WorkloadQuery(sql=event["sql"], calls=0, total_time=0)
+            )
+            query.calls += 1
+            query.total_time += event["total_time"]
+    return list(queries.values())
+
+
+async def load_pg_stat_statements(database_url: str) -> List[WorkloadQuery]:
+    conn = await asyncpg.connect(database_url)
+    try:
+        results = await conn.fetch(
+            """
+            SELECT query, calls, total_exec_time / 1000 AS total_time
+            FROM pg_stat_statements
+            WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database())
+        """
+        )
+    finally:
+        await conn.close()
+    return [
+        WorkloadQuery(sql=result["query"], calls=result["calls"], total_time=result["total_time"])
+        for result in results
+    ]
+
+
+def get_table_indexes(table: Table) -> List[Tuple[str, str, List[str]]]:
+    # (name, type, columns) of the primary key, unique columns and indexes of a table
+    indexes = []
+    for column in table.columns:
+        if column.primary_key:
+            indexes.append((f"{table.name}_pkey", "unique", [column.name]))
+        elif any(isinstance(constraint, UniqueConstraint) for constraint in column.constraints):
+            indexes.append((f"uq_{table.name}_{column.name}", "unique", [column.name]))
+    for index in table.indexes:
+        indexes.append((index.name, index.type, list(index.columns)))
+    return indexes
+
+
+def suggest_indexes(
+    workload: Iterable[WorkloadQuery], tables: Iterable[Table], min_calls: int = 1
+) -> List[IndexSuggestion]:
+    indexes_by_table: Dict[str, List[List[str]]] = {}
+    for table in tables:
+        indexes_by_table.setdefault(table.name, []).extend(
+            columns for _, _, columns in get_table_indexes(table)
+        )
+
+    suggestions: Dict[Tuple[str, Tuple[str, ...]], IndexSuggestion] = {}
+    for query in workload:
+        if query.calls < min_calls:
+            continue
+        for access in parse_query(query.sql).values():
+            if access.table not in indexes_by_table:
+                continue
+            candidate = access.candidate()
+            if len(candidate) == 0:
+                continue
+            leading_columns = set(access.equality) | {candidate[0]}
+            if any(index[0] in leading_columns for index in indexes_by_table[access.table]):
+                continue
+            suggestion = suggestions.setdefault(
+                (access.table, tuple(candidate)),
+                IndexSuggestion(table=access.table, columns=candidate, calls=0, total_time=0, queries=[]),
+            )
+            suggestion.calls += query.calls
+            suggestion.total_time += query.total_time
+            suggestion.queries.append(query.sql)
+
+    # An index on (a, b) also serves the queries that only need (a)
+    merged = sorted(suggestions.values(), key=lambda s: len(s.columns), reverse=True)
+    result: List[IndexSuggestion] = []
+    for suggestion in merged:
+        covering = next(
+            (
+                s
+                for s in result
+                if s.table == suggestion.table and s.columns[: len(suggestion.columns)] == suggestion.columns
+            ),
+            None,
+        )
+        if covering is None:
+            result.append(suggestion)
+        else:
+            covering.calls += suggestion.calls
+            covering.total_time += suggestion.total_time
+            covering.queries += suggestion.queries
+
+    return sorted(result, key=lambda s: s.total_time, reverse=True)
+
+
+def find_redundant_indexes(tables: Iterable[Table]) -> List[IndexFinding]:
+    findings = []
+    for table in tables:
+        indexes = get_table_indexes(table)
+        unique_columns = {columns[0] for _, type, columns in indexes if type == "unique" and len(columns) == 1}
+        for index in table.indexes:
+            name, type, columns = index.name, index.type, list(index.columns)
+            unique_column = next((column for column in columns if column in unique_columns), None)
+            covering = next(
+                (
+                    other_name
+                    for other_name, _, other_columns in indexes
+                    if other_name != name
+                    and type != "unique"
+                    and other_columns[: len(columns)] == columns
+                ),
+                None,
+            )
+            if covering is not None:
+                reason = f"its columns are a prefix of {covering}"
+            elif type == "unique" and unique_column is not None:
+                reason = f"uniqueness is already enforced by the unique column {unique_column}"
+            elif unique_column is not None and columns[0] == unique_column:
+                reason = f"lookups by the unique column {unique_column} are already served by its own index"
+            else:
+                continue
+            findings.append(IndexFinding(table=table.name, name=name, columns=columns, reason=reason))
+    return findings
+
+
+async def find_unused_indexes(database_url: str) -> List[IndexFinding]:
+    conn = await asyncpg.connect(database_url)
+    try:
+        results = await conn.fetch(
+            """
+            SELECT relname AS table_name, indexrelname AS index_name
+            FROM pg_stat_user_indexes
+            WHERE idx_scan = 0 AND indexrelname LIKE 'idx\\_%'
+        """
+        )
+    finally:
+        await conn.close()
+    return [
+        IndexFinding(
+            table=result["table_name"],
+            name=result["index_name"],
+            columns=[],
+            reason="it has not been scanned since statistics were last reset",
+        )
+        for result in results
+    ]
+
+
+def add_index_to_source(source: str, model: Type[Model], columns: List[str]) -> str:
+    lines = source.splitlines(keepends=True)
+
+    if re.search(r"^import actual_orm\.indexes as indexes$", source, re.MULTILINE):
+        index_name = "indexes.Index"
+    else:
+        index_name = "Index"
+        import_line = next(
+            (i for i, line in enumerate(lines) if line.startswith("from actual_orm.indexes import")),
+            None,
+        )
+        if import_line is None:
+            last_import = max(
+                i for i, line in enumerate(lines) if line.startswith(("import ", "from "))
+            )
+            lines.insert(last_import + 1, "from actual_orm.indexes import Index\n")
+        elif not re.search(r"\bIndex\b", lines[import_line].split("import", 1)[1]):
+            lines[import_line] = lines[import_line].rstrip("\n") + ", Index\n"
+
+    class_line = next(
+        i for i, line in enumerate(lines) if re.match(rf"class {model.__name__}\b", line)
+    )
+    entry = f"{index_name}([{", ".join(f'"{column}"' for column in columns)}])"
+
+    indexes_line = next(
+        (
+            i
+            for i, line in enumerate(lines)
+            if i > class_line and re.match(r"\s+__indexes__\s*=", line)
+        ),
+        None,
+    )
+    if indexes_line is None:
+        table_line = next(
+            i for i, line in enumerate(lines) if i > class_line and "__table_name__" in line
+        )
+        lines.insert(table_line + 1, f"    __indexes__ = [\n        {entry},\n    ]\n")
+        return "".join(lines)
+
+    # Find the line that closes the __indexes__ list
+    depth = 0
+    for end_line in range(indexes_line, len(lines)):
+        depth += lines[end_line].count("[") - lines[end_line].count("]")
+        if depth == 0:
+            break
+
+    if end_line == indexes_line:
+        lines[indexes_line] = re.sub(
+            r"\[(.*)\]", lambda m: f"[{m.group(1)}{", " if m.group(1).strip() else ""}{entry}]", lines[indexes_line]
+        )
+        return "".join(lines)
+
+    previous_line = end_line - 1
+    while lines[previous_line].strip() == "":
+        previous_line -= 1
+    if not lines[previous_line].rstrip().endswith((",", "[")):
+        lines[previous_line] = lines[previous_line].rstrip() + ",\n"
+    lines.insert(end_line, f"        {entry},\n")
+    return "".join(lines)
+
+
+def get_model_diff(model: Type[Model], indexes: List[List[str]]) -> Tuple[str, str, str]:
+    # Returns the path, the new source and a unified diff of the model file
+    path = inspect.getsourcefile(model) or ""
+    with open(path) as file:
+        source = file.read()
+    new_source = source
+    for columns in indexes:
+        new_source = add_index_to_source(new_source, model, columns)
+    relative_path = os.path.relpath(path)
+    diff = "".join(
+        difflib.unified_diff(
+            source.splitlines(keepends=True),
+            new_source.splitlines(keepends=True),
+            fromfile=f"a/{relative_path}",
+            tofile=f"b/{relative_path}",
+        )
+    )
+    return path, new_source, diff
@@ -110,6 +110,7 @@ def get_table_name(model: Type[Model]):
 
 def get_model_schema(model: Type[Model]):
     columns = []
+    indexed_foreign_keys = []
     for column_name, type in model.__annotations__.items():
         is_annotated = get_origin(type) is Annotated
         data_type = type
@@ -134,6 +135,8 @@ def get_model_schema(model: Type[Model]):
         unique: bool = meta_data.get("unique", False)
         if foreign_key != None:
             constraints.append(ForeignKeyConstraint(references=foreign_key.get("key"), on_delete=foreign_key.get("on_delete")))
+            if foreign_key.get("index", True):
+                indexed_foreign_keys.append(column_name)
         if unique:
             constraints.append(UniqueConstraint())
 
@@ -159,6 +162,25 @@ def get_model_schema(model: Type[Model]):
             )
         )
 
+    # Foreign key columns get an index unless one already leads with them, so
+    # lookups and ON DELETE from the referenced table don't scan this one
+    leading_columns = [index.columns[0] for index in indexes] + [
+        column.name
+        for column in columns
+        if column.primary_key
+        or any(isinstance(constraint, UniqueConstraint) for constraint in column.constraints)
+    ]
+    for column_name in indexed_foreign_keys:
+        if column_name in leading_columns:
+            continue
+        indexes.append(
+            Index(
+                name=f"idx_{get_table_name(model)}_index_{column_name}",
+                type="index",
+                columns=[column_name],
+            )
+        )
+
     table = Table(name=get_table_name(model), columns=columns, indexes=indexes)
     return table
 
@@ -3,8 +3,10 @@ import importlib
 import asyncpg
 
 
-async def run_migrations(database_url: str):
-    migration_file_names = os.listdir("database/migrations")
+async def run_migrations(database_url: str, package: str = "database"):
+    # package is the dotted path of the database package, relative to the
+    # working directory
+    migration_file_names = os.listdir(os.path.join(*package.split("."), "migrations"))
 
     conn = await asyncpg.connect(database_url)
     await conn.execute(
@@ -23,7 +25,7 @@ async def run_migrations(database_url: str):
             continue
 
         migration_name = migration_file_name.replace(".py", "")
-        module = importlib.import_module(f"database.migrations.{migration_name}")
+        module = importlib.import_module(f"{package}.migrations.{migration_name}")
 
         if migration_name in [record["name"] for record in already_ran]:
             continue
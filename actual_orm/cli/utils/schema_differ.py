@@ -1,6 +1,6 @@
 from typing import List, Optional, Tuple
 from dataclasses import dataclass
-from .schema import Table, Column, Constraint, Enum
+from .schema import Table, Column, Constraint, Enum, ForeignKeyConstraint, UniqueConstraint
 from .action import TableAction, EnumAction
 
 def get_schema_diff_actions(model_schema: Tuple[List[Table], List[Enum]], database_schema: Tuple[List[Table], List[Enum]]):
@@ -134,3 +134,20 @@ def get_schema_diff_actions(model_schema: Tuple[List[Table], List[Enum]], databa
                     actions.append(TableAction(type="ADD_CONSTRAINT", table=table, column=column, constraint=constraint))
 
     return actions
+
+
+def get_unindexed_foreign_keys(tables: List[Table]) -> List[Tuple[Table, Column]]:
+    # Foreign key columns that no index leads with
+    unindexed = []
+    for table in tables:
+        leading_columns = [index.columns[0] for index in table.indexes] + [
+            column.name
+            for column in table.columns
+            if column.primary_key
+            or any(isinstance(constraint, UniqueConstraint) for constraint in column.constraints)
+        ]
+        for column in table.columns:
+            is_foreign_key = any(isinstance(constraint, ForeignKeyConstraint) for constraint in column.constraints)
+            if is_foreign_key and column.name not in leading_columns:
+                unindexed.append((table, column))
+    return unindexed
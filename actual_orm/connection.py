@@ -1,16 +1,185 @@
-from typing import AsyncGenerator
+from typing import AsyncGenerator, Awaitable, Callable, Dict, List, Any
 import asyncio
 import asyncpg
 from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, asdict
+from enum import StrEnum, auto
+from itertools import count
+from zlib import crc32
+from time import monotonic
 from weakref import WeakKeyDictionary
+from . import pool_metrics
+from .retry import RetryPolicy
+
+ConnectionHook = Callable[[asyncpg.Connection], Awaitable[None]]
+
+@dataclass
+class PoolOptions:
+    # Mirrors the keyword arguments of asyncpg.create_pool and asyncpg.connect
+    min_size: int = 10
+    max_size: int = 10
+    max_queries: int = 50000
+    max_inactive_connection_lifetime: float = 300.0
+    statement_cache_size: int = 100
+    max_cached_statement_lifetime: int = 300
+    max_cacheable_statement_size: int = 1024 * 15
+    command_timeout: float | None = None
+    server_settings: Dict[str, str] | None = None
+    # Runs once for every new connection, before the hooks registered with on_connect
+    init: ConnectionHook | None = None
+    # Runs every time a connection is acquired from the pool
+    setup: ConnectionHook | None = None
+    # Seconds to wait for a free connection before raising asyncio.TimeoutError
+    acquire_timeout: float | None = None
+
+class ReplicaSelection(StrEnum):
+    ROUND_ROBIN = auto()
+    LEAST_BUSY = auto()
 
 # Use WeakKeyDictionary to automatically clean up closed event loops
 connection_url: str | None = None
+replica_urls: List[str] = []
+replica_selection = ReplicaSelection.ROUND_ROBIN
+read_your_writes_seconds: float | None = None
+shard_urls: Dict[str, str] = {}
+shard_resolver: Callable[[Any], str] | None = None
+pool_options = PoolOptions()
 connection_pools = WeakKeyDictionary()
+replica_pools = WeakKeyDictionary()
+shard_pools = WeakKeyDictionary()
+replica_counter = count()
+connection_init_hooks: List[ConnectionHook] = []
+in_list_threshold = 10_000
+# Seconds, see the statement_timeout option of configure()
+statement_timeout_seconds: float | None = None
+retry_policy: RetryPolicy | None = None
+# See the pgbouncer option of configure()
+pgbouncer_mode = False
+
+# The connection bound by the innermost connection_scope/start_transaction. Every
+# call that doesn't pass an explicit conn reuses it instead of acquiring another
+# connection from the pool.
+current_connection: ContextVar[asyncpg.Connection | None] = ContextVar(
+    "current_connection", default=None
+)
+# The shard current_connection belongs to, None for the primary
+current_shard: ContextVar[str | None] = ContextVar("current_shard", default=None)
+
+# Reads in this context go to the primary until this monotonic() deadline, see
+# the read_your_writes option of configure()
+primary_pinned_until: ContextVar[float] = ContextVar("primary_pinned_until", default=0.0)
+
+def configure(
+    database_url: str | None = None,
+    options: PoolOptions | None = None,
+    *,
+    primary: str | None = None,
+    replicas: List[str] | None = None,
+    selection: ReplicaSelection = ReplicaSelection.ROUND_ROBIN,
+    read_your_writes: float | None = None,
+    shards: Dict[str, str] | None = None,
+    shard_for: Callable[[Any], str] | None = None,
+    in_list_size: int = 10_000,
+    statement_timeout: float | None = None,
+    retry: RetryPolicy | None = None,
+    pgbouncer: bool = False,
+):
+    global connection_url, pool_options, replica_urls, replica_selection, read_your_writes_seconds
+    global shard_urls, shard_resolver, in_list_threshold, statement_timeout_seconds, retry_policy
+    global pgbouncer_mode
+    connection_url = primary or database_url
+    pool_options = options or (get_pgbouncer_pool_options() if pgbouncer else PoolOptions())
+    replica_urls = list(replicas or [])
+    replica_selection = selection
+    read_your_writes_seconds = read_your_writes
+    # Maps a shard name to its database URL. Models that declare __shard_key__
+    # are routed with shard_for(key value) -> shard name.
+    shard_urls = dict(shards or {})
+    shard_resolver = shard_for
+    # in_() and not_in() lists longer than this are loaded into a temp table
+    # with COPY and joined instead of being bound as a single array parameter
+    in_list_threshold = in_list_size
+    # Every statement running longer than this is cancelled by the server.
+    # QueryBuilder.timeout() overrides it for a single query.
+    statement_timeout_seconds = statement_timeout
+    # Reads outside of a connection_scope and retry_transaction() blocks are
+    # retried with this policy, QueryBuilder.retry() overrides it
+    retry_policy = retry
+    # The URLs point at PgBouncer in transaction pooling mode, which gives
+    # every transaction whichever server connection is free. Statements are
+    # sent unnamed instead of being prepared and cached per connection, and
+    # nothing relies on session state.
+    pgbouncer_mode = pgbouncer
+
+def get_pgbouncer_pool_options() -> PoolOptions:
+    # A connection to PgBouncer only holds a server connection while a
+    # transaction runs, so a larger pool costs little and leaves the queueing
+    # to PgBouncer. Idle connections are closed sooner.
+    return PoolOptions(min_size=1, max_size=50, max_inactive_connection_lifetime=60.0, statement_cache_size=0)
+
+def on_connect(hook: ConnectionHook) -> ConnectionHook:
+    # Registers a hook that runs on every new pool connection, e.g. to call
+    # conn.set_type_codec(). Usable as a decorator.
+    connection_init_hooks.append(hook)
+    return hook
+
+def prepare_on_connect(*queries: Any) -> ConnectionHook:
+    # Warms the statement cache of every new connection with the given
+    # QueryBuilders or (sql, parameters) tuples. Each query runs inside a
+    # transaction that is rolled back, the prepared statement outlives it.
+    async def prepare(conn: asyncpg.Connection):
+        # Behind PgBouncer statements aren't cached, there is nothing to warm
+        if pgbouncer_mode:
+            return
+        for query in queries:
+            sql, parameters = query if isinstance(query, tuple) else query.sql()
+            transaction = conn.transaction()
+            await transaction.start()
+            try:
+                await conn.fetch(sql, *parameters)
+            finally:
+                await transaction.rollback()
 
-def configure(database_url: str):
-    global connection_url
-    connection_url = database_url
+    return on_connect(prepare)
+
+async def init_connection(conn: asyncpg.Connection):
+    if pool_options.init is not None:
+        await pool_options.init(conn)
+    for hook in connection_init_hooks:
+        await hook(conn)
+
+async def skip_reset(conn: asyncpg.Connection):
+    pass
+
+async def create_pool(url: str, name: str) -> asyncpg.Pool:
+    async def init(conn: asyncpg.Connection):
+        await init_connection(conn)
+        pool_metrics.track_connection(name, conn)
+
+    options = asdict(pool_options)
+    options.pop("acquire_timeout")
+    options["init"] = init
+    if pgbouncer_mode:
+        # Named prepared statements live on one server connection, the next
+        # transaction may run on another one
+        options["statement_cache_size"] = 0
+        # Session state doesn't outlive a transaction behind PgBouncer, this
+        # skips the RESET ALL round trip on every release. Open transactions
+        # are still rolled back.
+        options["reset"] = skip_reset
+    if statement_timeout_seconds is not None and pgbouncer_mode:
+        # PgBouncer rejects unknown startup parameters, asyncpg enforces the
+        # timeout instead and cancels the statement through PgBouncer
+        options["command_timeout"] = options["command_timeout"] or statement_timeout_seconds
+    elif statement_timeout_seconds is not None:
+        options["server_settings"] = {
+            **(options["server_settings"] or {}),
+            "statement_timeout": str(int(statement_timeout_seconds * 1000)),
+        }
+    pool = await asyncpg.create_pool(url, **options)
+    pool_metrics.register_pool(pool, name)
+    return pool
 
 async def get_or_create_pool() -> asyncpg.Pool:
     global connection_url, connection_pools
@@ -20,29 +189,116 @@ async def get_or_create_pool() -> asyncpg.Pool:
     if loop not in connection_pools:
         if not connection_url:
             raise ValueError("Database URL is not configured. Call 'configure()' with a valid URL.")
-        
+
         # Initialize and store a new pool for this event loop
-        connection_pools[loop] = await asyncpg.create_pool(connection_url)
-    
+        connection_pools[loop] = await create_pool(connection_url, "primary")
+
     return connection_pools[loop]
 
+async def get_or_create_replica_pools() -> List[asyncpg.Pool]:
+    loop = asyncio.get_running_loop()
+
+    if loop not in replica_pools:
+        replica_pools[loop] = [
+            await create_pool(url, f"replica_{i}") for i, url in enumerate(replica_urls)
+        ]
+
+    return replica_pools[loop]
+
+async def get_replica_pool() -> asyncpg.Pool:
+    pools = await get_or_create_replica_pools()
+    match replica_selection:
+        case ReplicaSelection.LEAST_BUSY:
+            return min(pools, key=lambda pool: pool.get_size() - pool.get_idle_size())
+        case _:
+            return pools[next(replica_counter) % len(pools)]
+
+async def get_or_create_shard_pool(shard: str) -> asyncpg.Pool:
+    loop = asyncio.get_running_loop()
+    pools = shard_pools.setdefault(loop, {})
+
+    if shard not in pools:
+        if shard not in shard_urls:
+            raise ValueError(f"Shard {shard} is not configured. Call 'configure()' with a shard map.")
+        pools[shard] = await create_pool(shard_urls[shard], shard)
+
+    return pools[shard]
+
+def get_shard_names() -> List[str]:
+    return sorted(shard_urls.keys())
+
+def get_shard_for_key(value: Any) -> str:
+    if shard_resolver is not None:
+        return shard_resolver(value)
+    # crc32 is stable across processes, unlike hash()
+    shard_names = get_shard_names()
+    return shard_names[crc32(str(value).encode()) % len(shard_names)]
+
+def mark_primary_write():
+    # Pins the reads of the current context to the primary so they observe the write
+    if read_your_writes_seconds is not None:
+        primary_pinned_until.set(monotonic() + read_your_writes_seconds)
+
+def reads_from_replica() -> bool:
+    return len(replica_urls) > 0 and primary_pinned_until.get() <= monotonic()
+
+def has_scoped_connection(shard: str | None = None) -> bool:
+    # Whether get_connection() would reuse the connection of a connection_scope
+    return current_connection.get() is not None and current_shard.get() == shard
+
 @asynccontextmanager
-async def get_connection(conn: asyncpg.Connection | None = None) -> AsyncGenerator[asyncpg.Connection, None]:
-    pool = await get_or_create_pool()
+async def get_connection(
+    conn: asyncpg.Connection | None = None,
+    readonly: bool = False,
+    shard: str | None = None,
+) -> AsyncGenerator[asyncpg.Connection, None]:
+    if conn is None and current_shard.get() == shard:
+        conn = current_connection.get()
+
     if conn is None:
-        async with pool.acquire() as connection:
+        if shard is not None:
+            pool = await get_or_create_shard_pool(shard)
+        elif readonly and reads_from_replica():
+            pool = await get_replica_pool()
+        else:
+            pool = await get_or_create_pool()
+        async with pool_metrics.acquire(pool, pool_options.acquire_timeout) as connection:
             yield connection
     else:
         yield conn
 
 @asynccontextmanager
-async def start_transaction(conn: asyncpg.Connection | None = None):
-    async with get_connection(conn) as conn:
+async def connection_scope(
+    conn: asyncpg.Connection | None = None, shard: str | None = None
+) -> AsyncGenerator[asyncpg.Connection, None]:
+    # Nested scopes on the same database reuse the connection of the outer scope
+    async with get_connection(conn, shard=shard) as conn:
+        token = current_connection.set(conn)
+        shard_token = current_shard.set(shard)
+        try:
+            yield conn
+        finally:
+            current_shard.reset(shard_token)
+            current_connection.reset(token)
+
+@asynccontextmanager
+async def start_transaction(conn: asyncpg.Connection | None = None, shard: str | None = None):
+    async with connection_scope(conn, shard=shard) as conn:
+        # asyncpg turns a transaction started inside another one into a savepoint
         async with conn.transaction():
             yield conn
 
 async def close():
-    # Close all connection pools and clear the WeakKeyDictionary
-    pool = await get_or_create_pool()
-    await pool.close()
+    # Close the connection pools of the current event loop and forget them so the
+    # next query creates new ones. Buffered writes go out before that.
+    from .buffered_writer import close_writers
+    await close_writers()
 
+    loop = asyncio.get_running_loop()
+    pools = replica_pools.pop(loop, []) + list(shard_pools.pop(loop, {}).values())
+    pool = connection_pools.pop(loop, None)
+    if pool is not None:
+        pools.append(pool)
+    for pool in pools:
+        pool_metrics.unregister_pool(pool)
+        await pool.close()
@@ -1,2 +1,2 @@
 from . import data_types
-from .db import primary_key, auto_increment, now, default, foreign_key, unique, updated_at, cascade
\ No newline at end of file
+from .db import primary_key, auto_increment, now, random, default, foreign_key, unique, updated_at, cascade, coalesce, greatest, least
\ No newline at end of file
@@ -3,6 +3,7 @@ from enum import StrEnum, auto
 from dataclasses import field, fields
 # from .func import now, current_timestamp
 from actual_orm.model import Model
+from actual_orm.query_builder.expressions import RawSql, coalesce, greatest, least
 from . import data_types
 
 def primary_key():
@@ -15,10 +16,10 @@ def auto_increment():
     }
 
 def now():
-    return "NOW()"
+    return RawSql("NOW()")
 
 def random():
-    return "RANDOM()"
+    return RawSql("RANDOM()")
 
 def default(value: str):
     return {
@@ -33,13 +34,15 @@ def updated_at():
 def cascade():
     return { "on_delete": "CASCADE" }
 
-def foreign_key(references: type[Model], on_delete: Dict | None = None):
+def foreign_key(references: type[Model], on_delete: Dict | None = None, index: bool = True):
+    # index=False opts the column out of the index created for foreign keys
     primary_key = next((column_name for column_name, type in references.__annotations__.items() if get_origin(type) is Annotated and {"primary_key": True} in get_args(type)), None)
     if primary_key is None:
         raise Exception(f"No primary key found on table {references.__class__.__name__}")
     return {
         "foreign_key": {
             "key": f"{references.__table_name__}({primary_key})",
+            "index": index,
             **(on_delete or {})
         }
     }
@@ -0,0 +1,119 @@
+from typing import Any, Callable, List
+from dataclasses import dataclass
+from functools import lru_cache
+import json
+import logging
+import re
+
+logger = logging.getLogger("actual_orm.instrumentation")
+
+
+@dataclass
+class QueryEvent:
+    fingerprint: str
+    sql: str
+    table: str | None
+    model: str | None
+    query_type: str | None
+    # Positional parameters of sql and the names the query builder gave them,
+    # which contain the table and column they are compared to or written into
+    parameters: List[Any]
+    parameter_names: List[str]
+    shard: str | None
+    row_count: int
+    # Wall clock time the query started at in nanoseconds since the epoch
+    started_at: int
+    # Seconds spent building the SQL, waiting for a pool connection, waiting on
+    # the server and building model instances from the returned records
+    compile_time: float
+    acquire_time: float
+    execute_time: float
+    hydrate_time: float
+
+    @property
+    def total_time(self):
+        return self.compile_time + self.acquire_time + self.execute_time + self.hydrate_time
+
+
+QueryListener = Callable[[QueryEvent], Any]
+
+listeners: List[QueryListener] = []
+
+
+def add_query_listener(listener: QueryListener) -> QueryListener:
+    listeners.append(listener)
+    return listener
+
+
+def remove_query_listener(listener: QueryListener):
+    listeners.remove(listener)
+
+
+def emit(event: QueryEvent):
+    # Queries already ran when they're emitted, a failing listener mustn't turn
+    # a committed write into an error
+    for listener in listeners:
+        try:
+            listener(event)
+        except Exception:
+            logger.exception("Query listener %r failed", listener)
+
+
+@lru_cache(maxsize=1024)
+def fingerprint(sql: str) -> str:
+    # Queries that only differ in their literals or in how many rows they insert
+    # share a fingerprint
+    normalized = re.sub(r"'(?:[^']|'')*'", "?", sql)
+    normalized = re.sub(r"\$\d+", "?", normalized)
+    normalized = re.sub(r"\b\d+(\.\d+)?\b", "?", normalized)
+    normalized = re.sub(r"(\(\?(, \?)*\))(, \(\?(, \?)*\))+", r"\1", normalized)
+    return re.sub(r"\s+", " ", normalized).strip()
+
+
+class QueryLogWriter:
+    # Appends every query as a JSON line to path, the workload format read by
+    # `actual advise indexes --log path`
+    def __init__(self, path: str):
+        self.file = open(path, "a")
+
+    def __call__(self, event: QueryEvent):
+        record = {
+            "fingerprint": event.fingerprint,
+            "sql": event.sql,
+            "table": event.table,
+            "query_type": event.query_type,
+            "row_count": event.row_count,
+            "total_time": event.total_time,
+        }
+        self.file.write(json.dumps(record) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+class OpenTelemetryListener:
+    # Turns every query into a span of the given OpenTelemetry tracer, e.g.
+    # add_query_listener(OpenTelemetryListener(trace.get_tracer("actual_orm")))
+    def __init__(self, tracer: Any):
+        self.tracer = tracer
+
+    def __call__(self, event: QueryEvent):
+        attributes = {
+            "db.system": "postgresql",
+            "db.statement": event.fingerprint,
+            "db.operation": event.query_type or "",
+            "db.sql.table": event.table or "",
+            "db.response.returned_rows": event.row_count,
+            "actual_orm.compile_time": event.compile_time,
+            "actual_orm.acquire_time": event.acquire_time,
+            "actual_orm.execute_time": event.execute_time,
+            "actual_orm.hydrate_time": event.hydrate_time,
+        }
+        if event.model is not None:
+            attributes["actual_orm.model"] = event.model
+        span = self.tracer.start_span(
+            f"{(event.query_type or 'query').upper()} {event.table or ''}".strip(),
+            start_time=event.started_at,
+            attributes=attributes,
+        )
+        span.end(end_time=event.started_at + int(event.total_time * 1e9))
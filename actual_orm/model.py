@@ -10,29 +10,28 @@ from typing import (
     Tuple,
     TypeVar,
     Mapping,
+    Dict,
+    Callable,
 )
-import re
+from dataclasses import dataclass
+import asyncio
 from asyncpg import Connection
+from .connection import connection_scope, start_transaction
+from . import connection, sharding
+from .retry import retry_transaction
 from .query_builder.conditions import Condition, LogicalCondition, AndCondition
 from .query_builder.query_builder import QueryBuilder, OrderByDirection
+from .query_builder.expressions import RawSql
 from .dot_dict import DotDict
+from .buffered_writer import BufferedWriter
 from .query_builder.model_column import ModelColumn
 
 
-def convert_named_to_positional(sql: str, params: dict):
-    # Find all named parameters
-    param_names = re.findall(r":(\w+)", sql)
-    # Replace named parameters with positional ones like $1, $2, ...
-    transformed_sql = sql
-    for i, name in enumerate(param_names):
-        transformed_sql = transformed_sql.replace(f":{name}", f"${i+1}")
-    # Reorder the parameters according to their position in the query
-    transformed_params = [params[name] for name in param_names]
-    return transformed_sql, transformed_params
-
-
 T = TypeVar("T", bound="Model")
 
+# Every model class that declares a table, by table name
+models_by_table: Dict[str, Type["Model"]] = {}
+
 
 class MetaModel(type):
     def __init__(cls: Type["Model"], name, bases, dict):
@@ -42,6 +41,21 @@ class MetaModel(type):
         for name in cls.__annotations__.keys():
             cls.columns[name] = ModelColumn(table=cls.__table_name__, name=name)
 
+        if cls.__table_name__:
+            models_by_table[cls.__table_name__] = cls
+
+
+@dataclass
+class BatchProgress:
+    batches: int
+    rows: int
+    # Primary key of the last row of the last batch, pass it as after= to
+    # resume an interrupted run
+    last_key: Any
+    # Matching rows another transaction had locked, with skip_locked. The walk
+    # moves past them, run again to process them.
+    skipped: int = 0
+
 
 CreateT = TypeVar("CreateT", bound=Mapping[str, Any])
 UpdateT = TypeVar("UpdateT", bound=Mapping[str, Any])
@@ -84,6 +98,16 @@ class Model(Generic[CreateT, UpdateT], metaclass=MetaModel):
         cls._updated_at_columns = columns
         return cls._updated_at_columns
 
+    @classmethod
+    def _with_updated_at(cls, data: Mapping[str, Any]) -> Dict[str, Any]:
+        # updated_at columns are set by the database on every update unless
+        # the data sets them explicitly
+        data = dict(data)
+        for column_name in cls._get_updated_at_columns():
+            if column_name not in data:
+                data[column_name] = RawSql("NOW()")
+        return data
+
     @classmethod
     def _get_primary_key(cls) -> str:
         if cls._primary_key != None:
@@ -100,6 +124,43 @@ class Model(Generic[CreateT, UpdateT], metaclass=MetaModel):
 
         return cls._primary_key or ""
 
+    @classmethod
+    def _get_foreign_key_to(cls, model: Type["Model"]) -> str | None:
+        # The column of this model that references model's primary key
+        for column_name, type in cls.__annotations__.items():
+            if get_origin(type) is not Annotated:
+                continue
+            _, *annotations = get_args(type)
+            for annotation in annotations:
+                if (
+                    isinstance(annotation, dict)
+                    and "foreign_key" in annotation
+                    and annotation["foreign_key"]["key"].startswith(f"{model.__table_name__}(")
+                ):
+                    return column_name
+        return None
+
+    @classmethod
+    def _get_index_columns(cls) -> List[List[str]]:
+        # Column lists of every index the table has: the primary key, unique
+        # columns, indexed foreign keys and __indexes__
+        index_columns = []
+        for column_name, type in cls.__annotations__.items():
+            if get_origin(type) is not Annotated:
+                continue
+            _, *annotations = get_args(type)
+            if {"primary_key": True} in annotations or {"unique": True} in annotations:
+                index_columns.append([column_name])
+            elif any(
+                annotation.get("foreign_key", {}).get("index", False)
+                for annotation in annotations
+                if isinstance(annotation, dict)
+            ):
+                index_columns.append([column_name])
+        for index in cls.__indexes__:
+            index_columns.append(list(index.columns))
+        return index_columns
+
     @classmethod
     def _get_required_fields_to_insert(cls: Type[T]):
         if cls._required_fields_to_insert != None:
@@ -132,15 +193,9 @@ class Model(Generic[CreateT, UpdateT], metaclass=MetaModel):
         cls: Type[T],
         *conditions: LogicalCondition,
         conn: Connection | None = None,
+        timeout: float | None = None,
     ) -> T | None:
-        result: List[T] = (
-            await QueryBuilder()
-            .select(cls.__table_name__)
-            .where(AndCondition(*list(conditions)))
-            .limit(1)
-            .return_as(cls)
-            .run(conn)
-        )
+        result: List[T] = await cls._query_builder(AndCondition(*list(conditions)), None, 1, timeout).run(conn)
         if len(result) == 0:
             return None
         return result[0]
@@ -152,7 +207,36 @@ class Model(Generic[CreateT, UpdateT], metaclass=MetaModel):
         order_by: List[Tuple["ModelColumn", OrderByDirection]] | None = None,
         limit: int | None = None,
         conn: Connection | None = None,
+        timeout: float | None = None,
     ):
+        result: List[T] = await cls._query_builder(condition, order_by, limit, timeout).run(conn)
+        return result
+
+    @classmethod
+    async def query_many(
+        cls: Type[T],
+        conditions: List[LogicalCondition],
+        order_by: List[Tuple["ModelColumn", OrderByDirection]] | None = None,
+        limit: int | None = None,
+        max_concurrency: int | None = None,
+        timeout: float | None = None,
+    ) -> List[List[T]]:
+        # Runs one query per condition in parallel over the pool, see parallel()
+        from .parallel import parallel
+
+        return await parallel(
+            [cls._query_builder(condition, order_by, limit, timeout) for condition in conditions],
+            max_concurrency=max_concurrency,
+        )
+
+    @classmethod
+    def _query_builder(
+        cls: Type[T],
+        condition: LogicalCondition | None,
+        order_by: List[Tuple["ModelColumn", OrderByDirection]] | None,
+        limit: int | None,
+        timeout: float | None = None,
+    ) -> QueryBuilder[T]:
         query_builder = QueryBuilder().select(cls.__table_name__)
 
         if condition != None:
@@ -164,122 +248,355 @@ class Model(Generic[CreateT, UpdateT], metaclass=MetaModel):
         if limit != None:
             query_builder = query_builder.limit(limit)
 
-        query_builder = query_builder.return_as(cls)
+        if timeout != None:
+            query_builder = query_builder.timeout(timeout)
 
-        result: List[T] = await query_builder.run(conn)
-        return result
+        return query_builder.return_as(cls)
+
+    # returning=False skips RETURNING and makes the write return the affected
+    # row count, a list of columns or "pk" returns records with only those
+    # columns instead of models
 
     @classmethod
-    async def create(cls: Type[T], data: CreateT, conn: Connection | None = None) -> T:
+    async def create(
+        cls: Type[T],
+        data: CreateT,
+        conn: Connection | None = None,
+        returning: bool | List[str] | str = True,
+    ) -> T | int:
         results: List[T] = (
             await QueryBuilder()
             .insert(cls.__table_name__, dict(data))
             .return_as(cls)
+            .returning(returning)
             .run(conn)
         )
+        if returning == False:
+            return results
         return results[0]
 
     @classmethod
     async def create_many(
-        cls: Type[T], data: List[CreateT], conn: Connection | None = None
-    ) -> List[T]:
+        cls: Type[T],
+        data: List[CreateT],
+        conn: Connection | None = None,
+        returning: bool | List[str] | str = True,
+    ) -> List[T] | int:
         new_data = [dict(d) for d in data]
         results: List[T] = (
             await QueryBuilder()
             .insert(cls.__table_name__, new_data)
             .return_as(cls)
+            .returning(returning)
             .run(conn)
         )
         return results
 
+    @classmethod
+    def buffered_writer(
+        cls: Type[T], max_rows: int = 1000, max_latency_ms: float = 5, max_pending: int | None = None
+    ) -> BufferedWriter[T]:
+        # await writer.create(data) instead of Model.create(data) to batch
+        # many concurrent single row inserts
+        return BufferedWriter(cls, max_rows=max_rows, max_latency_ms=max_latency_ms, max_pending=max_pending)
+
     @classmethod
     async def update(
         cls: Type[T],
         data: UpdateT,
         condition: LogicalCondition,
         conn: Connection | None = None,
+        returning: bool | List[str] | str = True,
     ):
         result: List[T] = (
             await QueryBuilder()
-            .update(cls.__table_name__, dict(data))
+            .update(cls.__table_name__, cls._with_updated_at(data))
             .where(condition)
             .return_as(cls)
+            .returning(returning)
             .run(conn)
         )
         return result
 
     @classmethod
-    async def upsert(
+    async def claim(
         cls: Type[T],
-        where: LogicalCondition,
-        create: CreateT,
-        update: UpdateT,
+        data: UpdateT,
+        condition: LogicalCondition,
+        limit: int = 1,
+        order_by: List[Tuple["ModelColumn", OrderByDirection]] | None = None,
         conn: Connection | None = None,
-    ) -> T:
-        existing = (
+    ) -> List[T]:
+        # Updates up to limit matching rows with data and returns them, e.g.
+        # jobs claimed by a worker. Rows locked by another worker's claim are
+        # skipped instead of waited for, so many workers can drain one table.
+        # order_by picks the rows, they are returned in no particular order.
+        primary_key = cls._get_primary_key()
+        rows = (
+            QueryBuilder()
+            .select(cls.__table_name__, [primary_key])
+            .where(condition)
+            .order_by(*(order_by or []))
+            .limit(limit)
+            .for_update(skip_locked=True)
+        )
+        result: List[T] = (
             await QueryBuilder()
-            .select(cls.__table_name__)
-            .where(where)
+            .update(cls.__table_name__, cls._with_updated_at(data))
+            .where(cls.columns[primary_key].in_(rows))
             .return_as(cls)
             .run(conn)
         )
-        if len(existing) > 1:
-            raise Exception("Where condition for upsert was not unique")
-
-        if len(existing) == 1:
-            if len(update.keys()) == 0:
-                return existing[0]
-            
-            result = (
-                await QueryBuilder()
-                .update(cls.__table_name__, data=dict(update))
-                .where(where)
-                .return_as(cls)
-                .run()
-            )
-            return result[0]
-        else:
-            result = (
-                await QueryBuilder()
-                .insert(cls.__table_name__, data=dict(create))
-                .return_as(cls)
-                .run()
-            )
+        return result
+
+    @classmethod
+    async def upsert(
+        cls: Type[T],
+        where: LogicalCondition,
+        create: CreateT,
+        update: UpdateT,
+        conn: Connection | None = None,
+        returning: bool | List[str] | str = True,
+    ) -> T | int:
+        # The lookup and the write that follows it share a single connection,
+        # on a sharded model the connection to the row's shard
+        shard = cls._get_upsert_shard(where, create)
+        async with connection_scope(conn, shard=shard) as conn:
+            lookup = QueryBuilder().select(cls.__table_name__).where(where).return_as(cls).on_shard(shard)
+            if returning != True:
+                # Only the returned columns are needed from an existing row
+                lookup.returning("pk" if returning == False else returning)
+                lookup.return_columns = lookup.get_returning_columns()
+            existing = await lookup.run(conn)
+            if len(existing) > 1:
+                raise Exception("Where condition for upsert was not unique")
+
+            if len(existing) == 1:
+                if len(update.keys()) == 0:
+                    return 0 if returning == False else existing[0]
+
+                result = (
+                    await QueryBuilder()
+                    .update(cls.__table_name__, data=cls._with_updated_at(update))
+                    .where(where)
+                    .return_as(cls)
+                    .returning(returning)
+                    .on_shard(shard)
+                    .run(conn)
+                )
+            else:
+                result = (
+                    await QueryBuilder()
+                    .insert(cls.__table_name__, data=dict(create))
+                    .return_as(cls)
+                    .returning(returning)
+                    .on_shard(shard)
+                    .run(conn)
+                )
+            if returning == False:
+                return result
             return result[0]
 
+    @classmethod
+    def _get_upsert_shard(cls, where: LogicalCondition, create: CreateT) -> str | None:
+        shard_key = sharding.get_shard_key(cls)
+        if shard_key is None:
+            return None
+        if shard_key in create:
+            return connection.get_shard_for_key(create[shard_key])
+        shards = sharding.get_condition_shards(where, cls.__table_name__, shard_key)
+        if shards is None or len(shards) != 1:
+            raise Exception(f"Shard key {shard_key} is required to upsert into {cls.__table_name__}")
+        return shards.pop()
+
     async def update_self(self: T, conn: Connection | None = None) -> T:
         primary_key_column = self.__class__._get_primary_key()
+        updated_at_columns = self.__class__._get_updated_at_columns()
         data = {}
         for key in self.__annotations__.keys():
-            if primary_key_column == key:
+            if primary_key_column == key or key in updated_at_columns:
                 continue
             data[key] = getattr(self, key)
+        data = self.__class__._with_updated_at(data)
 
         result: List[T] = (
             await QueryBuilder()
             .update(self.__class__.__table_name__, data)
-            .where(
-                self.columns[primary_key_column] == getattr(self, primary_key_column)
-            )
+            .where(self._get_self_condition())
             .return_as(self.__class__)
             .run(conn)
         )
         return result[0]
 
+    def _get_self_condition(self) -> LogicalCondition:
+        # Primary keys are only unique within a shard, the shard key routes the
+        # query to the shard of this row
+        cls = self.__class__
+        primary_key = cls._get_primary_key()
+        condition = cls.columns[primary_key] == getattr(self, primary_key)
+        shard_key = sharding.get_shard_key(cls)
+        if shard_key is None:
+            return condition
+        return AndCondition(condition, cls.columns[shard_key] == getattr(self, shard_key))
+
     @classmethod
     async def delete(
         cls: Type[T], *conditions: LogicalCondition, conn: Connection | None = None
-    ):
-        await QueryBuilder().delete(cls.__table_name__).where(
+    ) -> int:
+        return await QueryBuilder().delete(cls.__table_name__).where(
             AndCondition(*list(conditions))
-        ).run()
+        ).return_as(cls).returning(False).run(conn)
+
+    @classmethod
+    async def delete_in_batches(
+        cls: Type[T],
+        *conditions: LogicalCondition,
+        batch_size: int = 5000,
+        sleep: float = 0,
+        skip_locked: bool = False,
+        after: Any = None,
+        on_progress: Callable[[BatchProgress], Any] | None = None,
+    ) -> int:
+        # Deletes the matching rows batch_size at a time in primary key order,
+        # committing every batch so locks and WAL stay bounded. sleep pauses
+        # between batches to let replicas catch up. With skip_locked, rows
+        # locked by another transaction are left alone and counted in
+        # BatchProgress.skipped.
+        return await cls._run_in_batches(
+            lambda: QueryBuilder().delete(cls.__table_name__),
+            list(conditions),
+            batch_size,
+            sleep,
+            skip_locked,
+            after,
+            on_progress,
+        )
+
+    @classmethod
+    async def update_in_batches(
+        cls: Type[T],
+        data: UpdateT,
+        condition: LogicalCondition,
+        batch_size: int = 5000,
+        sleep: float = 0,
+        skip_locked: bool = False,
+        after: Any = None,
+        on_progress: Callable[[BatchProgress], Any] | None = None,
+    ) -> int:
+        return await cls._run_in_batches(
+            lambda: QueryBuilder().update(cls.__table_name__, cls._with_updated_at(data)),
+            [condition],
+            batch_size,
+            sleep,
+            skip_locked,
+            after,
+            on_progress,
+        )
+
+    @classmethod
+    async def _run_in_batches(
+        cls,
+        get_builder: Callable[[], QueryBuilder],
+        conditions: List[LogicalCondition],
+        batch_size: int,
+        sleep: float,
+        skip_locked: bool,
+        after: Any,
+        on_progress: Callable[[BatchProgress], Any] | None,
+    ) -> int:
+        if connection.current_connection.get() is not None:
+            raise Exception(
+                "Batches can't run inside a connection_scope or transaction, every batch commits on its own"
+            )
+        primary_key = cls._get_primary_key()
+        primary_key_column = cls.columns[primary_key]
+        progress = BatchProgress(batches=0, rows=0, last_key=after)
+
+        # Sharded models are walked one shard at a time
+        shards: List[str | None] = [None]
+        shard_key = sharding.get_shard_key(cls)
+        if shard_key is not None:
+            shards = sharding.get_query_shards(get_builder().where(AndCondition(*conditions)), shard_key)
+
+        for shard in shards:
+            last_key = after
+            while True:
+                # Walking the primary key means every batch starts where the
+                # last one ended, even when updated rows still match the condition
+                batch_conditions = list(conditions)
+                if last_key is not None:
+                    batch_conditions.append(primary_key_column > last_key)
+
+                async def run_batch(conn: Connection):
+                    select_builder = (
+                        QueryBuilder()
+                        .select(cls.__table_name__, [primary_key])
+                        .where(AndCondition(*batch_conditions))
+                        .order_by((primary_key_column, OrderByDirection.ASC))
+                        .limit(batch_size)
+                    )
+                    if skip_locked:
+                        select_builder = select_builder.for_update(skip_locked=True)
+                    keys = [record[primary_key] for record in await select_builder.on_shard(shard).run(conn)]
+
+                    skipped = 0
+                    if skip_locked:
+                        # Without the lock the select also sees the locked rows
+                        # of the range this batch covers
+                        range_conditions = list(batch_conditions)
+                        if len(keys) == batch_size:
+                            range_conditions.append(primary_key_column <= keys[-1])
+                        in_range = await (
+                            QueryBuilder()
+                            .select(cls.__table_name__, [primary_key])
+                            .where(AndCondition(*range_conditions))
+                            .on_shard(shard)
+                            .run(conn)
+                        )
+                        skipped = len(in_range) - len(keys)
+                    if len(keys) == 0:
+                        return keys, 0, skipped
+
+                    # The conditions are checked again in case a row changed
+                    # after it was selected
+                    rows = await (
+                        get_builder()
+                        .where(AndCondition(primary_key_column.in_(keys), *conditions))
+                        .return_as(cls)
+                        .returning(False)
+                        .on_shard(shard)
+                        .run(conn)
+                    )
+                    return keys, rows, skipped
+
+                # A batch is retried as a whole, it selects its keys again
+                if connection.retry_policy is not None:
+                    keys, rows, skipped = await retry_transaction(run_batch, connection.retry_policy, shard=shard)
+                else:
+                    async with start_transaction(shard=shard) as conn:
+                        keys, rows, skipped = await run_batch(conn)
+                progress.skipped += skipped
+                if len(keys) == 0:
+                    if skipped > 0 and on_progress is not None:
+                        on_progress(progress)
+                    break
+
+                last_key = keys[-1]
+                progress.batches += 1
+                progress.rows += rows
+                progress.last_key = last_key
+                if on_progress is not None:
+                    on_progress(progress)
+                if len(keys) < batch_size:
+                    break
+                if sleep > 0:
+                    await asyncio.sleep(sleep)
+        return progress.rows
 
     async def delete_self(self, conn: Connection | None = None):
-        primary_key_column = self.__class__._get_primary_key()
-        primary_key_value = getattr(self, primary_key_column)
         await QueryBuilder().delete(self.__class__.__table_name__).where(
-            self.__class__.columns[primary_key_column] == primary_key_value
-        ).run(conn)
+            self._get_self_condition()
+        ).return_as(self.__class__).returning(False).run(conn)
 
     # @classmethod
     # async def upsert[
@@ -0,0 +1,38 @@
+from typing import Any, Awaitable, Iterable, List
+import asyncio
+from . import connection
+from .query_builder.query_builder import QueryBuilder
+
+
+def get_default_concurrency() -> int:
+    # Half of the pool, so a parallel fan-out leaves connections for other
+    # traffic
+    return max(1, connection.pool_options.max_size // 2)
+
+
+async def parallel(
+    queries: Iterable[QueryBuilder | Awaitable[Any]], max_concurrency: int | None = None
+) -> List[Any]:
+    # Runs the queries concurrently, at most max_concurrency at a time, and
+    # returns their results in order. queries are builders or awaitables such
+    # as Model.get(...). When one fails the others are cancelled and its
+    # exception is raised.
+    semaphore = asyncio.Semaphore(max_concurrency or get_default_concurrency())
+    queries = list(queries)
+    results: List[Any] = [None] * len(queries)
+
+    async def run(i: int, query: QueryBuilder | Awaitable[Any]):
+        async with semaphore:
+            # Every task acquires its own connection instead of sharing the
+            # caller's connection_scope, a connection runs one query at a time
+            connection.current_connection.set(None)
+            connection.current_shard.set(None)
+            results[i] = await (query.run() if isinstance(query, QueryBuilder) else query)
+
+    try:
+        async with asyncio.TaskGroup() as group:
+            for i, query in enumerate(queries):
+                group.create_task(run(i, query))
+    except ExceptionGroup as errors:
+        raise errors.exceptions[0]
+    return results
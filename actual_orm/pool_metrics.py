@@ -0,0 +1,189 @@
+from typing import Any, Callable, Dict, List, Tuple
+from bisect import bisect_left
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from time import perf_counter
+import asyncio
+import logging
+import traceback
+from weakref import WeakKeyDictionary
+import asyncpg
+
+logger = logging.getLogger("actual_orm.pool")
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+@dataclass
+class Histogram:
+    # counts[i] is the number of values <= buckets[i] and > buckets[i - 1], the
+    # last count is for values above every bucket
+    buckets: Tuple[float, ...] = DEFAULT_BUCKETS
+    counts: List[int] = field(default_factory=list)
+    count: int = 0
+    sum: float = 0.0
+
+    def __post_init__(self):
+        if len(self.counts) == 0:
+            self.counts = [0] * (len(self.buckets) + 1)
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+@dataclass
+class PoolStats:
+    name: str
+    size: int = 0
+    in_use: int = 0
+    idle: int = 0
+    acquires: int = 0
+    acquire_timeouts: int = 0
+    leaks: int = 0
+    acquire_wait: Histogram = field(default_factory=Histogram)
+    hold_time: Histogram = field(default_factory=Histogram)
+    connection_lifetime: Histogram = field(default_factory=Histogram)
+
+
+@dataclass
+class PoolEvent:
+    # One of acquire, acquire_timeout, release, leak or connection_closed
+    type: str
+    pool: str
+    # Seconds waited, held or connected depending on the event type
+    duration: float | None = None
+    stack: str | None = None
+
+
+PoolListener = Callable[[PoolEvent], Any]
+
+enabled = False
+leak_threshold: float | None = None
+stats: Dict[str, PoolStats] = {}
+# Pool names by event loop, like the pools in connection.py. asyncpg pools
+# can't be weakly referenced, the loop can, so the pools of a loop that ended
+# without close() are collected with it.
+pool_names: "WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[asyncpg.Pool, str]]" = WeakKeyDictionary()
+listeners: List[PoolListener] = []
+
+
+def configure_pool_metrics(enable: bool = True, leak_after: float | None = None):
+    # leak_after logs a warning with the acquiring stack trace for every
+    # connection held longer than that many seconds
+    global enabled, leak_threshold
+    enabled = enable
+    leak_threshold = leak_after
+
+
+def add_pool_listener(listener: PoolListener) -> PoolListener:
+    listeners.append(listener)
+    return listener
+
+
+def remove_pool_listener(listener: PoolListener):
+    listeners.remove(listener)
+
+
+def get_stats(name: str) -> PoolStats:
+    if name not in stats:
+        stats[name] = PoolStats(name=name)
+    return stats[name]
+
+
+def emit(event: PoolEvent):
+    # Runs inside acquire and release, a failing listener must not fail the query
+    for listener in listeners:
+        try:
+            listener(event)
+        except Exception:
+            logger.exception("Pool listener %r failed", listener)
+
+
+def get_pool_names() -> Dict[asyncpg.Pool, str]:
+    return pool_names.setdefault(asyncio.get_running_loop(), {})
+
+
+def register_pool(pool: asyncpg.Pool, name: str):
+    get_pool_names()[pool] = name
+
+
+def unregister_pool(pool: asyncpg.Pool):
+    get_pool_names().pop(pool, None)
+
+
+def pool_stats() -> Dict[str, PoolStats]:
+    # Counters accumulate for the life of the process, the gauges reflect the
+    # pools that are currently open
+    pools = [(pool, name) for names in list(pool_names.values()) for pool, name in names.items()]
+    for pool, name in pools:
+        pool_stat = get_stats(name)
+        pool_stat.size = pool.get_size()
+        pool_stat.idle = pool.get_idle_size()
+        pool_stat.in_use = pool_stat.size - pool_stat.idle
+    return dict(stats)
+
+
+def track_connection(name: str, conn: asyncpg.Connection):
+    if not enabled:
+        return
+    connected_at = perf_counter()
+
+    def on_close(_):
+        lifetime = perf_counter() - connected_at
+        get_stats(name).connection_lifetime.observe(lifetime)
+        emit(PoolEvent(type="connection_closed", pool=name, duration=lifetime))
+
+    conn.add_termination_listener(on_close)
+
+
+def warn_leak(name: str, acquired_at: float, stack: str):
+    held = perf_counter() - acquired_at
+    get_stats(name).leaks += 1
+    logger.warning(
+        "Connection from pool %s held for %.1fs, acquired at:\n%s", name, held, stack
+    )
+    emit(PoolEvent(type="leak", pool=name, duration=held, stack=stack))
+
+
+@asynccontextmanager
+async def instrumented_acquire(pool: asyncpg.Pool, timeout: float | None):
+    name = get_pool_names().get(pool, "unknown")
+    pool_stat = get_stats(name)
+
+    start = perf_counter()
+    try:
+        connection = await pool.acquire(timeout=timeout)
+    except asyncio.TimeoutError:
+        pool_stat.acquire_timeouts += 1
+        emit(PoolEvent(type="acquire_timeout", pool=name, duration=perf_counter() - start))
+        raise
+    acquired_at = perf_counter()
+    pool_stat.acquires += 1
+    pool_stat.acquire_wait.observe(acquired_at - start)
+    emit(PoolEvent(type="acquire", pool=name, duration=acquired_at - start))
+
+    leak_handle = None
+    if leak_threshold is not None:
+        stack = "".join(traceback.format_stack()[:-2])
+        leak_handle = asyncio.get_running_loop().call_later(
+            leak_threshold, warn_leak, name, acquired_at, stack
+        )
+
+    try:
+        yield connection
+    finally:
+        if leak_handle is not None:
+            leak_handle.cancel()
+        held = perf_counter() - acquired_at
+        pool_stat.hold_time.observe(held)
+        emit(PoolEvent(type="release", pool=name, duration=held))
+        await pool.release(connection)
+
+
+def acquire(pool: asyncpg.Pool, timeout: float | None = None):
+    # Falls back to the plain pool context manager when metrics are disabled
+    if not enabled:
+        return pool.acquire(timeout=timeout)
+    return instrumented_acquire(pool, timeout)
@@ -1,2 +1,3 @@
 from .query_builder import QueryBuilder, OrderByDirection
-from .conditions import AndCondition, OrCondition, Condition
\ No newline at end of file
+from .conditions import AndCondition, OrCondition, NotCondition, ExistsCondition, Condition, exists
+from .expressions import RawSql, coalesce, greatest, least
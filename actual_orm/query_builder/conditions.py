@@ -1,35 +1,176 @@
 from typing import Any, Union, List
 from dataclasses import dataclass
+from datetime import datetime, date
+from uuid import UUID
+import asyncpg
 from .model_column import ModelColumn
+from .expressions import value_to_sql
 from ..nanoid import nanoid
+from .. import connection
 
-LogicalCondition = Union["Condition", "AndCondition", "OrCondition"]
+LogicalCondition = Union["Condition", "AndCondition", "OrCondition", "NotCondition", "ExistsCondition"]
+
+# The operator each operator is rewritten to when a condition is negated, so
+# ~condition stays a plain comparison an index can serve instead of NOT (...)
+INVERSE_OPERATORS = {
+    "=": "<>",
+    "<>": "=",
+    "<": ">=",
+    ">=": "<",
+    ">": "<=",
+    "<=": ">",
+    "in": "not in",
+    "not in": "in",
+    "between": "not between",
+    "not between": "between",
+    "like": "not like",
+    "not like": "like",
+    "ilike": "not ilike",
+    "not ilike": "ilike",
+    "is null": "is not null",
+    "is not null": "is null",
+}
+
+# Postgres type of the temp table column for in_() lists without an explicit type
+PYTHON_TYPES = {
+    bool: "bool",
+    int: "int8",
+    float: "float8",
+    str: "text",
+    UUID: "uuid",
+    datetime: "timestamptz",
+    date: "date",
+}
+
+@dataclass
+class InListTable:
+    # A temp table holding the values of a long in_() list. Compiled queries
+    # return it among their parameters, it has to be loaded on the connection
+    # the query runs on, inside a transaction, before the query runs.
+    name: str
+    values: List[Any]
+    type: str
+
+    async def load(self, conn: asyncpg.Connection):
+        await conn.execute(f"CREATE TEMP TABLE {self.name} (value {self.type}) ON COMMIT DROP")
+        await conn.copy_records_to_table(self.name, records=[(value,) for value in self.values])
+        # Temp tables are never auto-analyzed, without statistics the planner
+        # can't pick between a hash join and a nested loop
+        await conn.execute(f"ANALYZE {self.name}")
+
+def get_in_list_tables(parameters: dict) -> List[InListTable]:
+    return [value for value in parameters.values() if isinstance(value, InListTable)]
 
 @dataclass
 class Condition:
     column: ModelColumn
     condition: str
     value: Any
+    # Postgres type the parameter is cast to, e.g. jsonb
+    cast: str | None = None
 
-    def to_sql(self):
-        if isinstance(self.value, ModelColumn):
-            return (
-                f"{self.column.table}.{self.column.name} {self.condition} {self.value.table}.{self.value.name}",
-                {},
+    def __invert__(self):
+        if self.condition in INVERSE_OPERATORS:
+            return Condition(
+                column=self.column,
+                condition=INVERSE_OPERATORS[self.condition],
+                value=self.value,
+                cast=self.cast,
             )
+        return NotCondition(self)
+
+    def to_sql(self):
+        column_sql = f"{self.column.table}.{self.column.name}"
+
+        # Other columns and expressions like db.now() or a column + 1
+        if hasattr(self.value, "to_sql"):
+            value_sql, parameters = value_to_sql(self.value, f"condition_{self.column.table}_{self.column.name}")
+            return f"{column_sql} {self.condition.upper()} {value_sql}", parameters
+
+        if self.condition in ("is null", "is not null"):
+            return f"{column_sql} {self.condition.upper()}", {}
+
+        # Comparing with None can never be true, so it means IS NULL
+        if self.value is None and self.condition in ("=", "<>"):
+            return f"{column_sql} {"IS NULL" if self.condition == "=" else "IS NOT NULL"}", {}
 
         parameter_name = f"condition_{self.column.table}_{self.column.name}_{nanoid()}"
+        parameter_sql = f":{parameter_name}"
+        if self.cast != None:
+            parameter_sql = f"CAST({parameter_sql} AS {self.cast})"
+
+        if self.condition in ("in", "not in") and len(self.value) > connection.in_list_threshold:
+            return self.in_list_table_sql(column_sql)
 
         if self.condition == "in":
-            return f"{self.column.table}.{self.column.name} = ANY(:{parameter_name})", {
-                parameter_name: self.value
-            }
+            return f"{column_sql} = ANY({parameter_sql})", {parameter_name: self.value}
+
+        if self.condition == "not in":
+            return f"{column_sql} <> ALL({parameter_sql})", {parameter_name: self.value}
+
+        if self.condition in ("between", "not between"):
+            low, high = self.value
+            return (
+                f"{column_sql} {self.condition.upper()} :{parameter_name}_low AND :{parameter_name}_high",
+                {f"{parameter_name}_low": low, f"{parameter_name}_high": high},
+            )
 
         return (
-            f"{self.column.table}.{self.column.name} {self.condition} :{parameter_name}",
+            f"{column_sql} {self.condition.upper()} {parameter_sql}",
             {parameter_name: self.value},
         )
 
+    def in_list_table_sql(self, column_sql: str):
+        # NULLs never equal a column, = ANY() ignores them and <> ALL() is
+        # never true once the list contains one
+        values = [value for value in self.value if value is not None]
+        if len(values) == 0 or (self.condition == "not in" and len(values) < len(self.value)):
+            return "FALSE", {}
+
+        if self.cast != None:
+            value_type = self.cast.removesuffix("[]")
+        elif type(values[0]) in PYTHON_TYPES:
+            value_type = PYTHON_TYPES[type(values[0])]
+        else:
+            raise Exception(f"Pass type= to in_() to compare {self.column.name} with {type(values[0]).__name__} values")
+
+        # Temp tables are per connection, the name only has to be unique within it
+        table = InListTable(name=f"in_list_{nanoid().lower()}", values=values, type=value_type)
+        if self.condition == "in":
+            sql = f"{column_sql} IN (SELECT value FROM {table.name})"
+        else:
+            # Matches <> ALL(), which is never true for a NULL column
+            sql = f"({column_sql} IS NOT NULL AND NOT EXISTS (SELECT 1 FROM {table.name} WHERE {table.name}.value = {column_sql}))"
+        return sql, {table.name: table}
+
+@dataclass
+class ExistsCondition:
+    # query is a QueryBuilder, usually correlated with the outer query through
+    # a column to column condition
+    query: Any
+    negated: bool = False
+
+    def __invert__(self):
+        return ExistsCondition(query=self.query, negated=not self.negated)
+
+    def to_sql(self):
+        query_sql, parameters = self.query.to_sql()
+        return f"{"NOT " if self.negated else ""}EXISTS {query_sql}", parameters
+
+def exists(query: Any) -> ExistsCondition:
+    return ExistsCondition(query=query)
+
+@dataclass
+class NotCondition:
+    condition: LogicalCondition
+
+    def __invert__(self):
+        return self.condition
+
+    def to_sql(self):
+        condition_sql, parameters = self.condition.to_sql()
+        return f"NOT ({condition_sql})", parameters
+
 @dataclass
 class OrCondition:
     conditions: List[LogicalCondition]
@@ -37,6 +178,9 @@ class OrCondition:
     def __init__(self, *conditions: LogicalCondition):
         self.conditions = list(conditions)
 
+    def __invert__(self):
+        return AndCondition(*[~condition for condition in self.conditions])
+
     def to_sql(self):
         parameters = {}
         sql_statements = []
@@ -54,6 +198,9 @@ class AndCondition:
     def __init__(self, *conditions: LogicalCondition):
         self.conditions = list(conditions)
 
+    def __invert__(self):
+        return OrCondition(*[~condition for condition in self.conditions])
+
     def to_sql(self):
         parameters = {}
         sql_statements = []
@@ -62,4 +209,3 @@ class AndCondition:
             sql_statements.append(condition_sql)
             parameters.update(condition_parameters)
         return f"({" AND ".join(sql_statements)})", parameters
-
@@ -0,0 +1,89 @@
+from typing import Any, Dict, List, Tuple
+from dataclasses import dataclass
+from ..nanoid import nanoid
+
+
+class ArithmeticMixin:
+    # Arithmetic on columns and expressions builds an expression that is
+    # evaluated by Postgres, e.g. {"views": Content.columns.views + 1}
+    def __add__(self, other):
+        return BinaryExpression(self, "+", other)
+
+    def __radd__(self, other):
+        return BinaryExpression(other, "+", self)
+
+    def __sub__(self, other):
+        return BinaryExpression(self, "-", other)
+
+    def __rsub__(self, other):
+        return BinaryExpression(other, "-", self)
+
+    def __mul__(self, other):
+        return BinaryExpression(self, "*", other)
+
+    def __rmul__(self, other):
+        return BinaryExpression(other, "*", self)
+
+    def __truediv__(self, other):
+        return BinaryExpression(self, "/", other)
+
+    def __rtruediv__(self, other):
+        return BinaryExpression(other, "/", self)
+
+
+class RawSql(str):
+    # SQL inserted verbatim. A str so it still works as a column default,
+    # e.g. db.default(db.now())
+    def to_sql(self) -> Tuple[str, Dict[str, Any]]:
+        return str(self), {}
+
+
+def value_to_sql(value: Any, name: str) -> Tuple[str, Dict[str, Any]]:
+    # Columns and expressions are compiled, anything else is bound as a
+    # parameter. Parameters inside an expression are named like the column it
+    # is written into or compared to, so redaction rules by column cover them.
+    if isinstance(value, (BinaryExpression, Function)):
+        return value.to_sql(name)
+    if hasattr(value, "to_sql"):
+        return value.to_sql()
+    parameter_name = f"{name}_{nanoid()}"
+    return f":{parameter_name}", {parameter_name: value}
+
+
+@dataclass(eq=False)
+class BinaryExpression(ArithmeticMixin):
+    left: Any
+    operator: str
+    right: Any
+
+    def to_sql(self, name: str = "expression") -> Tuple[str, Dict[str, Any]]:
+        left_sql, parameters = value_to_sql(self.left, name)
+        right_sql, right_parameters = value_to_sql(self.right, name)
+        return f"({left_sql} {self.operator} {right_sql})", {**parameters, **right_parameters}
+
+
+@dataclass(eq=False)
+class Function(ArithmeticMixin):
+    name: str
+    arguments: List[Any]
+
+    def to_sql(self, name: str = "expression") -> Tuple[str, Dict[str, Any]]:
+        parameters = {}
+        arguments_sql = []
+        for argument in self.arguments:
+            argument_sql, argument_parameters = value_to_sql(argument, name)
+            arguments_sql.append(argument_sql)
+            parameters.update(argument_parameters)
+        return f"{self.name}({", ".join(arguments_sql)})", parameters
+
+
+def coalesce(*values: Any) -> Function:
+    return Function("COALESCE", list(values))
+
+
+def greatest(*values: Any) -> Function:
+    return Function("GREATEST", list(values))
+
+
+def least(*values: Any) -> Function:
+    return Function("LEAST", list(values))
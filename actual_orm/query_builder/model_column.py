@@ -1,23 +1,125 @@
 from dataclasses import dataclass
 from typing import List, Any
+import json
+from .expressions import ArithmeticMixin
+
+# Postgres element type for NumPy arrays by dtype.kind
+NUMPY_TYPES = {
+    "i": "int8",
+    "u": "int8",
+    "f": "float8",
+    "b": "bool",
+    "U": "text",
+}
+
+def get_array_values(values: Any, type: str | None):
+    # NumPy arrays (duck typed, numpy isn't a dependency) become lists typed by
+    # their dtype so they are sent as binary int8[]/float8[] arrays
+    if hasattr(values, "dtype") and hasattr(values, "tolist"):
+        return values.tolist(), type or NUMPY_TYPES.get(values.dtype.kind)
+    return values, type
 
 @dataclass
-class ModelColumn:
+class ModelColumn(ArithmeticMixin):
     table: str
     name: str
 
-    def in_(self, values: List[Any]):
+    def to_sql(self):
+        return f"{self.table}.{self.name}", {}
+
+    def in_(self, values: List[Any], type: str | None = None):
+        # type is the Postgres element type, e.g. int8 or uuid. The parameter is
+        # cast to that array type so every call shares one statement and plan.
         from .conditions import Condition
-        return Condition(column=self, condition="in", value=values)
+        values, type = get_array_values(values, type)
+        return Condition(column=self, condition="in", value=values, cast=f"{type}[]" if type else None)
+
+    def not_in(self, values: List[Any], type: str | None = None):
+        from .conditions import Condition
+        values, type = get_array_values(values, type)
+        return Condition(column=self, condition="not in", value=values, cast=f"{type}[]" if type else None)
 
     def __lt__(self, other):
         from .conditions import Condition
         return Condition(column=self, condition="<", value=other)
 
+    def __le__(self, other):
+        from .conditions import Condition
+        return Condition(column=self, condition="<=", value=other)
+
     def __gt__(self, other):
         from .conditions import Condition
         return Condition(column=self, condition=">", value=other)
 
+    def __ge__(self, other):
+        from .conditions import Condition
+        return Condition(column=self, condition=">=", value=other)
+
     def __eq__(self, other):
         from .conditions import Condition
-        return Condition(column=self, condition="=", value=other)
\ No newline at end of file
+        return Condition(column=self, condition="=", value=other)
+
+    def __ne__(self, other):
+        from .conditions import Condition
+        return Condition(column=self, condition="<>", value=other)
+
+    def is_null(self):
+        from .conditions import Condition
+        return Condition(column=self, condition="is null", value=None)
+
+    def is_not_null(self):
+        from .conditions import Condition
+        return Condition(column=self, condition="is not null", value=None)
+
+    def between(self, low: Any, high: Any):
+        from .conditions import Condition
+        return Condition(column=self, condition="between", value=(low, high))
+
+    def like(self, pattern: str):
+        # Only a pattern without a leading wildcard can use a btree index
+        from .conditions import Condition
+        return Condition(column=self, condition="like", value=pattern)
+
+    def ilike(self, pattern: str):
+        from .conditions import Condition
+        return Condition(column=self, condition="ilike", value=pattern)
+
+    def not_like(self, pattern: str):
+        from .conditions import Condition
+        return Condition(column=self, condition="not like", value=pattern)
+
+    def not_ilike(self, pattern: str):
+        from .conditions import Condition
+        return Condition(column=self, condition="not ilike", value=pattern)
+
+    # Array columns, served by GIN indexes
+
+    def contains(self, values: List[Any]):
+        from .conditions import Condition
+        return Condition(column=self, condition="@>", value=values)
+
+    def contained_by(self, values: List[Any]):
+        from .conditions import Condition
+        return Condition(column=self, condition="<@", value=values)
+
+    def overlaps(self, values: List[Any]):
+        from .conditions import Condition
+        return Condition(column=self, condition="&&", value=values)
+
+    # jsonb columns, served by GIN indexes
+
+    def json_contains(self, value: Any):
+        from .conditions import Condition
+        return Condition(column=self, condition="@>", value=json.dumps(value), cast="jsonb")
+
+    def has_key(self, key: str):
+        from .conditions import Condition
+        return Condition(column=self, condition="?", value=key)
+
+    def has_any_keys(self, keys: List[str]):
+        from .conditions import Condition
+        return Condition(column=self, condition="?|", value=keys)
+
+    def has_all_keys(self, keys: List[str]):
+        from .conditions import Condition
+        return Condition(column=self, condition="?&", value=keys)
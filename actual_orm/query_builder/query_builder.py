@@ -1,25 +1,138 @@
-from typing import List, Optional, Tuple, Dict, TypeVar, Type, Generic
+from typing import Any, Callable, List, Optional, Tuple, Dict, TypeVar, Type, Generic
 from contextlib import asynccontextmanager
 from dataclasses import dataclass
 from enum import StrEnum, auto
-from asyncpg import Connection
+from asyncpg import Connection, Record
+from time import perf_counter, time_ns
+import json
 import re
-from .. import get_connection
+from ..connection import get_connection, mark_primary_write
+from .. import sharding, instrumentation, connection
+from ..retry import RetryPolicy
 from .model_column import ModelColumn
-from .conditions import LogicalCondition, Condition
+from .conditions import LogicalCondition, Condition, InListTable, get_in_list_tables
+from .query_plan import QueryPlan, parse_plan
+from .expressions import value_to_sql
 from ..nanoid import nanoid
 
+# A named parameter, but not the type of a ::cast
+PARAMETER_PATTERN = re.compile(r"(?<![:\w]):(\w+)")
+
+def get_parameter_names(sql: str) -> List[str]:
+    names = {}
+    for name in PARAMETER_PATTERN.findall(sql):
+        names.setdefault(name, None)
+    return list(names)
+
 def convert_named_to_positional(sql: str, params: dict):
-    # Find all named parameters
-    param_names = re.findall(r":(\w+)", sql)
-    # Replace named parameters with positional ones like $1, $2, ...
-    transformed_sql = sql
-    for i, name in enumerate(param_names):
-        transformed_sql = transformed_sql.replace(f":{name}", f"${i+1}")
+    # Replace named parameters with positional ones like $1, $2, ... in a single
+    # pass, a parameter used twice keeps its first position
+    positions: Dict[str, str] = {}
+
+    def replace(match: re.Match) -> str:
+        name = match.group(1)
+        if name not in positions:
+            positions[name] = f"${len(positions) + 1}"
+        return positions[name]
+
+    transformed_sql = PARAMETER_PATTERN.sub(replace, sql)
     # Reorder the parameters according to their position in the query
-    transformed_params = [params[name] for name in param_names]
+    transformed_params = [params[name] for name in positions]
     return transformed_sql, transformed_params
 
+async def fetch(
+    conn: Connection,
+    sql: str,
+    params: List,
+    in_list_tables: List[InListTable],
+    execute: bool = False,
+    timeout: float | None = None,
+) -> List[Record] | int:
+    # With execute the rows aren't sent back, only the affected row count.
+    # On timeout, or when the awaiting task is cancelled, asyncpg cancels the
+    # statement on the server as well.
+    in_transaction = conn.is_in_transaction()
+    # Inside a transaction the timeout is also set for the server with SET
+    # LOCAL, outside of one only when it has to outlast the configured default.
+    # Behind PgBouncer the default isn't a server setting.
+    local_timeout = timeout != None and (
+        in_transaction
+        or (
+            connection.statement_timeout_seconds != None
+            and not connection.pgbouncer_mode
+            and timeout > connection.statement_timeout_seconds
+        )
+    )
+    if len(in_list_tables) == 0 and not local_timeout:
+        return await fetch_or_execute(conn, sql, params, execute, timeout)
+    # The temp tables are dropped when this transaction commits. Inside a
+    # transaction this is a savepoint, so a timed out statement doesn't abort
+    # the outer transaction.
+    async with conn.transaction():
+        previous_timeout = None
+        if local_timeout:
+            # The select list is evaluated in order, so this is the value
+            # from before set_config()
+            previous_timeout = await conn.fetchval(
+                "SELECT current_setting('statement_timeout'), set_config('statement_timeout', $1, true)",
+                str(int(timeout * 1000)),
+            )
+        for table in in_list_tables:
+            await table.load(conn)
+        results = await fetch_or_execute(conn, sql, params, execute, timeout)
+        # SET LOCAL lasts until the outer transaction ends, not the savepoint
+        if in_transaction and previous_timeout != None:
+            await conn.execute("SELECT set_config('statement_timeout', $1, true)", previous_timeout)
+        return results
+
+async def fetch_or_execute(
+    conn: Connection, sql: str, params: List, execute: bool, timeout: float | None = None
+) -> List[Record] | int:
+    if not execute:
+        return await conn.fetch(sql, *params, timeout=timeout)
+    # The command status ends with the row count, e.g. UPDATE 3 or INSERT 0 3
+    status = await conn.execute(sql, *params, timeout=timeout)
+    return int(status.split()[-1])
+
+def no_clock() -> float:
+    return 0.0
+
+# Row hydrators by (return_as_cls, related_models)
+hydrators: Dict[Tuple, Callable[[Record], Any]] = {}
+
+def get_hydrator(model_cls: Type, related_models: Tuple[Tuple[Type, str | None], ...]):
+    key = (model_cls, related_models)
+    if key not in hydrators:
+        hydrators[key] = compile_hydrator(model_cls, related_models)
+    return hydrators[key]
+
+def compile_hydrator(model_cls: Type, related_models: Tuple[Tuple[Type, str | None], ...]):
+    # Works out once where every model's columns are in the row, so hydrating
+    # a row is a slice and a positional constructor call per model
+    model_count = len(model_cls.__annotations__)
+    layout = []
+    start = model_count
+    for model, name in related_models:
+        columns = list(model.__annotations__.keys())
+        primary_key_index = start + columns.index(model._get_primary_key())
+        layout.append((model, name, start, start + len(columns), primary_key_index))
+        start += len(columns)
+    returns_tuple = any(name == None for _, name, _, _, _ in layout)
+
+    def hydrate_row(record: Record):
+        instance = model_cls(*record[:model_count])
+        row = [instance]
+        for model, name, start, end, primary_key_index in layout:
+            # A LEFT JOIN miss has NULL in every column, primary key included
+            related = None if record[primary_key_index] is None else model(*record[start:end])
+            if name == None:
+                row.append(related)
+            else:
+                setattr(instance, name, related)
+        return tuple(row) if returns_tuple else instance
+
+    return hydrate_row
+
 class OrderByDirection(StrEnum):
     ASC = auto()
     DESC = auto()
@@ -41,6 +154,25 @@ class Join:
         condition_sql, parameters = self.condition.to_sql()
         return f"{self.type} {self.table} ON {condition_sql}", parameters
 
+@dataclass
+class Lock:
+    # UPDATE or SHARE
+    strength: str
+    skip_locked: bool
+    nowait: bool
+    # Tables to lock, all tables of the query when empty
+    of: List[str]
+
+    def to_sql(self):
+        sql = f" FOR {self.strength}"
+        if len(self.of) > 0:
+            sql += f" OF {", ".join(self.of)}"
+        if self.skip_locked:
+            sql += " SKIP LOCKED"
+        if self.nowait:
+            sql += " NOWAIT"
+        return sql
+
 T = TypeVar('T')
 
 class QueryBuilder(Generic[T]):
@@ -54,6 +186,20 @@ class QueryBuilder(Generic[T]):
     return_columns: List[str]
     return_as_cls: Type[T] | None
     data: List[Dict] | Dict | None
+    shard_name: str | None
+    # True returns every column of return_as_cls, False returns nothing and
+    # makes run() return the affected row count
+    returning_value: bool | List[str] | str
+    lock: Lock | None
+    # Seconds, overrides the statement_timeout of configure()
+    timeout_value: float | None
+    # Overrides the retry policy of configure() for reads
+    retry_policy: RetryPolicy | None
+    # Common table expressions by name, compiled into a WITH clause
+    ctes: List[Tuple[str, "QueryBuilder"]]
+    # Joined models hydrated along with return_as_cls and the attribute of the
+    # return_as_cls instance they are set on, None returns them in a tuple
+    related_models: List[Tuple[Type, str | None]]
 
     def __init__(self):
         self.return_model = None
@@ -67,6 +213,13 @@ class QueryBuilder(Generic[T]):
         self.return_columns = []
         self.return_as_cls = None
         self.data = None
+        self.shard_name = None
+        self.returning_value = True
+        self.ctes = []
+        self.related_models = []
+        self.lock = None
+        self.timeout_value = None
+        self.retry_policy = None
 
     def select(self, table: str | None = None, columns: List[str] | None = None):
         self.query_type = QueryType.SELECT
@@ -75,7 +228,9 @@ class QueryBuilder(Generic[T]):
 
         return self
 
-    def insert(self, table: str, data: List[Dict] | Dict):
+    def insert(self, table: str, data: "List[Dict] | Dict | QueryBuilder"):
+        # data can be a select builder for INSERT ... SELECT, the columns it
+        # selects are the columns inserted into
         self.query_type = QueryType.INSERT
         self.table = table
         self.data = data
@@ -126,13 +281,75 @@ class QueryBuilder(Generic[T]):
         self.limit_value = limit
         return self
 
+    def returning(self, columns: bool | List[str] | str):
+        # False, a list of columns or "pk" for the primary key of return_as_cls.
+        # With a list of columns run() returns records instead of models.
+        self.returning_value = columns
+        return self
+
+    def with_(self, name: str, query: "QueryBuilder"):
+        # Adds WITH name AS (query). The query may be an insert, update or
+        # delete with returning() to use the rows it wrote.
+        self.ctes.append((name, query))
+        return self
+
+    # Row locks only last until the end of the transaction, so run locking
+    # selects inside start_transaction()
+    def for_update(self, skip_locked: bool = False, nowait: bool = False, of: List[str] | None = None):
+        return self.set_lock("UPDATE", skip_locked, nowait, of)
+
+    def for_share(self, skip_locked: bool = False, nowait: bool = False, of: List[str] | None = None):
+        return self.set_lock("SHARE", skip_locked, nowait, of)
+
+    def set_lock(self, strength: str, skip_locked: bool, nowait: bool, of: List[str] | None):
+        if skip_locked and nowait:
+            raise Exception("A lock can either skip locked rows or fail on them, not both")
+        self.lock = Lock(strength=strength, skip_locked=skip_locked, nowait=nowait, of=of or [])
+        return self
+
+    def timeout(self, seconds: float):
+        self.timeout_value = seconds
+        return self
+
+    def retry(self, policy: RetryPolicy):
+        self.retry_policy = policy
+        return self
+
+    def on_shard(self, shard: str):
+        self.shard_name = shard
+        return self
+
     def order_by(self, *columns: Tuple["ModelColumn", OrderByDirection] | str):
         self.order_by_conditions += columns
         return self
     
-    def return_as(self, model_cls: Type[T]):
+    def return_as(self, model_cls: Type[T], *related_models: Type):
+        # With joined models every row is returned as a tuple of instances,
+        # (model_cls, *related_models), None for the misses of a LEFT JOIN
         self.return_as_cls = model_cls
         self.return_columns = list(model_cls.__annotations__.keys())
+        self.related_models = [(model, None) for model in related_models]
+        return self
+
+    def select_related(self, model: Type, name: str | None = None):
+        # Hydrates model from the same row and sets it on the return_as_cls
+        # instance as name, the snake cased model name by default. Without an
+        # explicit join on its table, model is LEFT JOINed through the foreign
+        # key return_as_cls has to it.
+        if self.return_as_cls == None:
+            raise Exception("select_related() needs return_as() first")
+        if all(join.table != model.__table_name__ for join in self.joins):
+            foreign_key = self.return_as_cls._get_foreign_key_to(model)
+            if foreign_key == None:
+                raise Exception(
+                    f"{self.return_as_cls.__name__} has no foreign key to {model.__name__}, join it explicitly"
+                )
+            self.left_join(
+                model.__table_name__,
+                model.columns[model._get_primary_key()] == self.return_as_cls.columns[foreign_key],
+            )
+        name = name or re.sub(r"([a-z0-9])([A-Z])", r"\1_\2", model.__name__).lower()
+        self.related_models.append((model, name))
         return self
 
     def select_sql(self):
@@ -142,7 +359,15 @@ class QueryBuilder(Generic[T]):
         parameters = {}
         query = f"SELECT "
         query += "DISTINCT " if self.is_distinct else ""
-        query += ", ".join([f"{self.table}.{column}" for column in self.return_columns])
+        columns = [f"{self.table}.{column}" for column in self.return_columns]
+        # Aliased so every column name in the row is unique, the hydrator
+        # reads them by position
+        for model, _ in self.related_models:
+            columns += [
+                f"{model.__table_name__}.{column} AS {model.__table_name__}__{column}"
+                for column in model.__annotations__.keys()
+            ]
+        query += ", ".join(columns)
         query += f" FROM {self.table}"
 
         if len(self.joins) > 0:
@@ -162,10 +387,6 @@ class QueryBuilder(Generic[T]):
                 where_sql.append(sql)
                 parameters.update(params)
             query += " AND ".join(where_sql)
-        if self.limit_value != None:
-            limit_param_name = f"limit_{nanoid()}"
-            query += f" LIMIT :{limit_param_name}"
-            parameters[limit_param_name] = self.limit_value
         if len(self.order_by_conditions) > 0:
             query += " ORDER BY "
             order_by = []
@@ -176,8 +397,14 @@ class QueryBuilder(Generic[T]):
                     column, direction = o
                     order_by.append(f"{column.table}.{column.name} {direction}")
             query += ", ".join(order_by)
+        if self.limit_value != None:
+            limit_param_name = f"limit_{nanoid()}"
+            query += f" LIMIT :{limit_param_name}"
+            parameters[limit_param_name] = self.limit_value
+        if self.lock != None:
+            query += self.lock.to_sql()
 
-        return convert_named_to_positional(query, parameters)
+        return query, parameters
 
     def insert_sql(self):
         if self.table == None:
@@ -187,6 +414,12 @@ class QueryBuilder(Generic[T]):
         
         query: str = "INSERT INTO "
         query += self.table
+
+        if isinstance(self.data, QueryBuilder):
+            select_sql, parameters = self.data.named_sql()
+            query += f" ({", ".join(self.data.return_columns)}) {select_sql}"
+            query += self.returning_sql()
+            return query, parameters
         
         columns = self.data[0].keys() if isinstance(self.data, list) else self.data.keys()
         query += f" ({", ".join(columns)})"
@@ -197,26 +430,25 @@ class QueryBuilder(Generic[T]):
             for row in self.data:
                 row_sql = []
                 for i, column in enumerate(columns):
-                    parameter_name = f"row_{i}_{column}_{nanoid()}"
-                    parameters[parameter_name] = row[column]
-                    row_sql.append(f":{parameter_name}")
+                    value_sql, value_parameters = value_to_sql(row[column], f"row_{i}_{column}")
+                    parameters.update(value_parameters)
+                    row_sql.append(value_sql)
                 rows_sql.append(f"({", ".join(row_sql)})")
         else:
             row_sql = []
             for column in columns:
-                parameter_name = f"row_{column}_{nanoid()}"
-                parameters[parameter_name] = self.data[column]
-                row_sql.append(f":{parameter_name}")
+                value_sql, value_parameters = value_to_sql(self.data[column], f"row_{column}")
+                parameters.update(value_parameters)
+                row_sql.append(value_sql)
             rows_sql.append(f"({", ".join(row_sql)})")
 
         query += " VALUES "
         query += ", ".join(rows_sql)
 
 
-        if self.return_as_cls != None:
-            query += f" RETURNING {", ".join([name for name in self.return_as_cls.__annotations__.keys()])}"
+        query += self.returning_sql()
 
-        return convert_named_to_positional(query, parameters)
+        return query, parameters
 
     def update_sql(self):
         if self.data is None:
@@ -230,9 +462,10 @@ class QueryBuilder(Generic[T]):
         parameters = {}
         update_sql = []
         for key, value in self.data.items():
-            parameter_name = f"column_{self.table}_{key}_{nanoid()}"
-            update_sql.append(f"{key} = :{parameter_name}")
-            parameters[parameter_name] = value
+            # Expressions are evaluated by Postgres against the row being updated
+            value_sql, value_parameters = value_to_sql(value, f"column_{self.table}_{key}")
+            update_sql.append(f"{key} = {value_sql}")
+            parameters.update(value_parameters)
         query += ", ".join(update_sql)
 
         query += " WHERE "
@@ -247,10 +480,28 @@ class QueryBuilder(Generic[T]):
 
         query += " AND ".join(conditions_sql)
 
-        if self.return_as_cls != None:
-            query += f" RETURNING {", ".join([name for name in self.return_as_cls.__annotations__.keys()])}"
-        
-        return convert_named_to_positional(query, parameters)
+        query += self.returning_sql()
+
+        return query, parameters
+
+    def get_returning_columns(self) -> List[str]:
+        if self.returning_value == False:
+            return []
+        if self.returning_value == True:
+            if self.return_as_cls == None:
+                return []
+            return list(self.return_as_cls.__annotations__.keys())
+        if self.returning_value == "pk":
+            if self.return_as_cls == None:
+                raise Exception("returning(\"pk\") needs return_as() to know the primary key")
+            return [self.return_as_cls._get_primary_key()]
+        return list(self.returning_value)
+
+    def returning_sql(self):
+        columns = self.get_returning_columns()
+        if len(columns) == 0:
+            return ""
+        return f" RETURNING {", ".join(columns)}"
 
     def delete_sql(self):
         query = f"DELETE FROM {self.table}"
@@ -264,28 +515,176 @@ class QueryBuilder(Generic[T]):
             parameters.update(params)
 
         query += " AND ".join(conditions_sql)
+        query += self.returning_sql()
 
-        return convert_named_to_positional(query, parameters)
+        return query, parameters
 
     def sql(self):
+        return convert_named_to_positional(*self.named_sql())
+
+    def named_sql(self):
         match self.query_type:
             case QueryType.SELECT:
-                return self.select_sql()
+                query, parameters = self.select_sql()
             case QueryType.INSERT:
-                return self.insert_sql()
+                query, parameters = self.insert_sql()
             case QueryType.UPDATE:
-                return self.update_sql()
+                query, parameters = self.update_sql()
             case QueryType.DELETE:
-                return self.delete_sql()
+                query, parameters = self.delete_sql()
             case _:
                 raise Exception(f"Query type {self.query_type} is not implemented")
 
+        if len(self.ctes) == 0:
+            return query, parameters
+
+        # Parameter names are unique across builders, so merging them and
+        # numbering the combined statement once is enough
+        ctes_sql = []
+        for name, cte in self.ctes:
+            cte_sql, cte_parameters = cte.named_sql()
+            ctes_sql.append(f"{name} AS ({cte_sql})")
+            parameters.update(cte_parameters)
+        return f"WITH {", ".join(ctes_sql)} {query}", parameters
+
+    def to_sql(self):
+        # Lets a builder be used as a value, e.g. col.in_(subquery),
+        # exists(subquery) or col == subquery
+        query, parameters = self.named_sql()
+        return f"({query})", parameters
+
+    def is_readonly(self):
+        # A select with a data-modifying CTE or row locks has to run on the primary
+        return (
+            self.query_type == QueryType.SELECT
+            and self.lock == None
+            and all(cte.is_readonly() for _, cte in self.ctes)
+        )
+
     async def run(self, conn: Connection | None = None) -> List[T]:
-        async with get_connection(conn) as conn:
-            sql, params = self.sql()
-            results = await conn.fetch(sql, *params)
-        if self.return_as_cls == None:
+        if (
+            conn is None
+            and self.shard_name is None
+            and sharding.get_shard_key(self.return_as_cls) is not None
+        ):
+            # Every shard's query comes back through run() with on_shard(), so
+            # the retry policy applies to each shard on its own
+            return await sharding.run_sharded(self)
+
+        # Only reads are repeated, a write that lost its connection may have
+        # committed. Scoped connections run once, they can't be swapped out.
+        policy = self.retry_policy or connection.retry_policy
+        if (
+            policy != None
+            and conn is None
+            and not connection.has_scoped_connection(self.shard_name)
+            and self.is_readonly()
+        ):
+            return await policy.run("query", self.run_once)
+        return await self.run_once(conn)
+
+    async def run_once(self, conn: Connection | None = None) -> List[T]:
+        # Timings are only taken when a listener will receive them
+        instrumented = len(instrumentation.listeners) > 0
+        clock = perf_counter if instrumented else no_clock
+        started_at = time_ns() if instrumented else 0
+        start = clock()
+        readonly = self.is_readonly()
+        named_sql, named_params = self.named_sql()
+        sql, params = convert_named_to_positional(named_sql, named_params)
+        in_list_tables = get_in_list_tables(named_params)
+        # A hot standby can't create the temp tables of long in_() lists
+        on_replica = readonly and len(in_list_tables) == 0
+        compiled = clock()
+        async with get_connection(conn, readonly=on_replica, shard=self.shard_name) as conn:
+            acquired = clock()
+            results = await fetch(conn, sql, params, in_list_tables, self.executes(), self.timeout_value)
+            executed = clock()
+        if not readonly and self.shard_name is None:
+            mark_primary_write()
+        hydrate_start = clock()
+        hydrated = self.hydrate(results)
+        if not instrumented:
+            return hydrated
+        hydrated_at = clock()
+
+        instrumentation.emit(
+            instrumentation.QueryEvent(
+                fingerprint=instrumentation.fingerprint(sql),
+                sql=sql,
+                table=self.table,
+                model=self.return_as_cls.__name__ if self.return_as_cls != None else None,
+                query_type=self.query_type,
+                parameters=params,
+                parameter_names=get_parameter_names(named_sql),
+                shard=self.shard_name,
+                row_count=results if isinstance(results, int) else len(results),
+                started_at=started_at,
+                compile_time=compiled - start,
+                acquire_time=acquired - compiled,
+                execute_time=executed - acquired,
+                hydrate_time=hydrated_at - hydrate_start,
+            )
+        )
+        return hydrated
+
+    async def explain(
+        self, analyze: bool = False, buffers: bool | None = None, conn: Connection | None = None
+    ) -> QueryPlan:
+        # buffers defaults to analyze. Writes explained with analyze are rolled back.
+        options = ["FORMAT JSON"]
+        if analyze:
+            options.append("ANALYZE")
+        if buffers if buffers is not None else analyze:
+            options.append("BUFFERS")
+
+        readonly = self.is_readonly()
+        named_sql, named_params = self.named_sql()
+        sql, params = convert_named_to_positional(named_sql, named_params)
+        in_list_tables = get_in_list_tables(named_params)
+        explain_sql = f"EXPLAIN ({", ".join(options)}) {sql}"
+        on_replica = readonly and len(in_list_tables) == 0
+        # fetch() loads the temp tables and applies timeout() like run() does
+        async with get_connection(conn, readonly=on_replica, shard=self.shard_name) as conn:
+            if analyze and not readonly:
+                transaction = conn.transaction()
+                await transaction.start()
+                try:
+                    [[plan]] = await fetch(conn, explain_sql, params, in_list_tables, timeout=self.timeout_value)
+                finally:
+                    await transaction.rollback()
+            else:
+                [[plan]] = await fetch(conn, explain_sql, params, in_list_tables, timeout=self.timeout_value)
+
+        return parse_plan(json.loads(plan), self.conditions + [join.condition for join in self.joins])
+
+    def get_column_names(self) -> List[str]:
+        # Names of the columns a select returns, in order
+        names = list(self.return_columns)
+        for model, _ in self.related_models:
+            names += [f"{model.__table_name__}__{column}" for column in model.__annotations__.keys()]
+        return names
+
+    def hydrate_tuples(self, rows: List[Tuple]) -> List[T]:
+        # Rows that were decoded from anonymous records, see batch()
+        if self.return_as_cls == None or self.returning_value != True:
+            names = self.get_column_names()
+            return [dict(zip(names, row)) for row in rows]
+        elif len(self.related_models) > 0:
+            hydrate_row = get_hydrator(self.return_as_cls, tuple(self.related_models))
+            return [hydrate_row(row) for row in rows]
+        else:
+            return [self.return_as_cls(**dict(zip(self.return_columns, row))) for row in rows]
+
+    def executes(self):
+        # Writes without RETURNING only report how many rows they touched
+        return self.query_type != QueryType.SELECT and self.returning_value == False
+
+    def hydrate(self, results: List[Record] | int) -> List[T]:
+        if isinstance(results, int) or self.return_as_cls == None or self.returning_value != True:
             return results
+        elif len(self.related_models) > 0 and self.query_type == QueryType.SELECT:
+            hydrate_row = get_hydrator(self.return_as_cls, tuple(self.related_models))
+            return [hydrate_row(result) for result in results]
         else:
             return [self.return_as_cls(**result) for result in results]
-
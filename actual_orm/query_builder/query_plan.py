@@ -0,0 +1,138 @@
+from typing import Any, Dict, Iterator, List, Set
+from dataclasses import dataclass, field
+from .conditions import Condition, AndCondition, OrCondition, NotCondition, LogicalCondition
+from .model_column import ModelColumn
+
+SEQUENTIAL_SCANS = ("Seq Scan", "Parallel Seq Scan")
+
+
+@dataclass
+class PlanNode:
+    node_type: str
+    relation_name: str | None
+    alias: str | None
+    index_name: str | None
+    plan_rows: float
+    # Only set when the plan was captured with analyze
+    actual_rows: float | None
+    actual_loops: float | None
+    actual_total_time: float | None
+    # Only set when the plan was captured with buffers
+    shared_hit_blocks: int | None
+    shared_read_blocks: int | None
+    filter: str | None
+    children: List["PlanNode"]
+    raw: Dict[str, Any] = field(repr=False)
+
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> "PlanNode":
+        return cls(
+            node_type=data["Node Type"],
+            relation_name=data.get("Relation Name"),
+            alias=data.get("Alias"),
+            index_name=data.get("Index Name"),
+            plan_rows=data.get("Plan Rows", 0),
+            actual_rows=data.get("Actual Rows"),
+            actual_loops=data.get("Actual Loops"),
+            actual_total_time=data.get("Actual Total Time"),
+            shared_hit_blocks=data.get("Shared Hit Blocks"),
+            shared_read_blocks=data.get("Shared Read Blocks"),
+            filter=data.get("Filter"),
+            children=[cls.from_json(child) for child in data.get("Plans", [])],
+            raw=data,
+        )
+
+    def walk(self) -> Iterator["PlanNode"]:
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+
+@dataclass
+class MissedIndex:
+    # A sequential scan on a table whose model declares an index that leads
+    # with a column the query filters or joins on
+    table: str
+    columns: List[str]
+    indexes: List[List[str]]
+    node: PlanNode
+
+
+@dataclass
+class QueryPlan:
+    root: PlanNode
+    planning_time: float | None
+    execution_time: float | None
+    missed_indexes: List[MissedIndex]
+    raw: Any = field(repr=False)
+
+    @property
+    def nodes(self) -> List[PlanNode]:
+        return list(self.root.walk())
+
+    @property
+    def sequential_scans(self) -> List[PlanNode]:
+        return [node for node in self.nodes if node.node_type in SEQUENTIAL_SCANS]
+
+    def index_names(self) -> Set[str]:
+        return {node.index_name for node in self.nodes if node.index_name is not None}
+
+
+def iter_condition_columns(condition: LogicalCondition) -> Iterator[ModelColumn]:
+    if isinstance(condition, Condition):
+        yield condition.column
+        if isinstance(condition.value, ModelColumn):
+            yield condition.value
+    elif isinstance(condition, (AndCondition, OrCondition)):
+        for child in condition.conditions:
+            yield from iter_condition_columns(child)
+    elif isinstance(condition, NotCondition):
+        yield from iter_condition_columns(condition.condition)
+
+
+def get_predicate_columns(conditions: List[LogicalCondition]) -> Dict[str, List[str]]:
+    columns: Dict[str, List[str]] = {}
+    for condition in conditions:
+        for column in iter_condition_columns(condition):
+            table_columns = columns.setdefault(column.table, [])
+            if column.name not in table_columns:
+                table_columns.append(column.name)
+    return columns
+
+
+def find_missed_indexes(
+    root: PlanNode, conditions: List[LogicalCondition]
+) -> List[MissedIndex]:
+    from ..model import models_by_table
+
+    predicate_columns = get_predicate_columns(conditions)
+    missed = []
+    for node in root.walk():
+        if node.node_type not in SEQUENTIAL_SCANS or node.relation_name is None:
+            continue
+        model = models_by_table.get(node.relation_name)
+        columns = predicate_columns.get(node.relation_name, [])
+        if model is None or len(columns) == 0:
+            continue
+        indexes = [
+            index_columns
+            for index_columns in model._get_index_columns()
+            if index_columns[0] in columns
+        ]
+        if len(indexes) > 0:
+            missed.append(
+                MissedIndex(table=node.relation_name, columns=columns, indexes=indexes, node=node)
+            )
+    return missed
+
+
+def parse_plan(raw: Any, conditions: List[LogicalCondition]) -> QueryPlan:
+    [explained] = raw
+    root = PlanNode.from_json(explained["Plan"])
+    return QueryPlan(
+        root=root,
+        planning_time=explained.get("Planning Time"),
+        execution_time=explained.get("Execution Time"),
+        missed_indexes=find_missed_indexes(root, conditions),
+        raw=raw,
+    )
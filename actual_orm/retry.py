@@ -0,0 +1,129 @@
+from typing import Any, Awaitable, Callable, List, Tuple, Type, TypeVar
+from dataclasses import dataclass, field
+import asyncio
+import random
+import asyncpg
+
+R = TypeVar("R")
+
+# Failures after which running the same statement or transaction again can
+# succeed. Postgres rolled the work back, or the connection was lost before
+# any of it could commit, e.g. during a failover. asyncpg raises
+# InterfaceError for a connection that was closed under it and OSError when
+# connecting fails.
+RETRYABLE_ERRORS: Tuple[Type[BaseException], ...] = (
+    asyncpg.SerializationError,
+    asyncpg.DeadlockDetectedError,
+    asyncpg.PostgresConnectionError,
+    asyncpg.CannotConnectNowError,
+    asyncpg.AdminShutdownError,
+    asyncpg.InterfaceError,
+    OSError,
+)
+
+# Subclasses of the errors above that fail the same way every time. Timeouts
+# are OSErrors too, running a timed out statement again only adds load.
+NON_RETRYABLE_ERRORS: Tuple[Type[BaseException], ...] = (
+    asyncpg.exceptions._base.DataError,
+    asyncpg.ClientConfigurationError,
+    asyncpg.UnsupportedClientFeatureError,
+    asyncpg.UnsupportedServerFeatureError,
+    TimeoutError,
+)
+
+
+@dataclass
+class RetryEvent:
+    # "query" or "transaction"
+    operation: str
+    # 1 for the first retry
+    attempt: int
+    # Seconds slept before the retry
+    delay: float
+    error: BaseException
+
+
+RetryListener = Callable[[RetryEvent], Any]
+
+listeners: List[RetryListener] = []
+
+
+def add_retry_listener(listener: RetryListener) -> RetryListener:
+    listeners.append(listener)
+    return listener
+
+
+def remove_retry_listener(listener: RetryListener):
+    listeners.remove(listener)
+
+
+@dataclass
+class RetryPolicy:
+    # Retries after the first attempt
+    attempts: int = 3
+    # Seconds, the delay before retry n is random between 0 and
+    # min(max_delay, base_delay * 2 ** n)
+    base_delay: float = 0.05
+    max_delay: float = 2.0
+    # The retry budget. Every call adds budget retries to it, up to
+    # budget_size, and every retry takes one. Once it's empty errors are raised
+    # right away, so a failing database doesn't get a multiple of the load.
+    budget: float = 0.1
+    budget_size: float = 10
+    errors: Tuple[Type[BaseException], ...] = RETRYABLE_ERRORS
+    on_retry: RetryListener | None = None
+    tokens: float = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.tokens = self.budget_size
+
+    def get_delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    def is_retryable(self, error: BaseException) -> bool:
+        return isinstance(error, self.errors) and not isinstance(error, NON_RETRYABLE_ERRORS)
+
+    def take_token(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    async def run(self, operation: str, fn: Callable[[], Awaitable[R]]) -> R:
+        self.tokens = min(self.budget_size, self.tokens + self.budget)
+        attempt = 0
+        while True:
+            try:
+                return await fn()
+            except self.errors as e:
+                if not self.is_retryable(e) or attempt >= self.attempts or not self.take_token():
+                    raise
+                attempt += 1
+                event = RetryEvent(operation=operation, attempt=attempt, delay=self.get_delay(attempt), error=e)
+                if self.on_retry is not None:
+                    self.on_retry(event)
+                for listener in listeners:
+                    listener(event)
+                await asyncio.sleep(event.delay)
+
+
+async def retry_transaction(
+    fn: Callable[[asyncpg.Connection], Awaitable[R]],
+    policy: RetryPolicy | None = None,
+    shard: str | None = None,
+) -> R:
+    # Runs fn(conn) in a transaction and runs it again in a new one when the
+    # transaction fails with a retryable error, fn has to be safe to repeat.
+    # Inside a connection_scope or transaction it runs once, retrying on that
+    # connection wouldn't help.
+    from . import connection
+
+    policy = policy or connection.retry_policy or RetryPolicy()
+
+    async def attempt():
+        async with connection.start_transaction(shard=shard) as conn:
+            return await fn(conn)
+
+    if connection.current_connection.get() is not None:
+        return await attempt()
+    return await policy.run("transaction", attempt)
@@ -0,0 +1,143 @@
+from typing import Any, Dict, List, Set, TYPE_CHECKING
+from functools import cmp_to_key
+import asyncio
+import copy
+import heapq
+from . import connection
+from .query_builder.conditions import Condition, AndCondition, OrCondition, LogicalCondition
+
+if TYPE_CHECKING:
+    from .query_builder.query_builder import QueryBuilder
+
+
+def get_shard_key(model: Any) -> str | None:
+    if model is None or len(connection.shard_urls) == 0:
+        return None
+    return getattr(model, "__shard_key__", None)
+
+
+def get_condition_shards(condition: LogicalCondition, table: str, shard_key: str) -> Set[str] | None:
+    # Returns the shards a condition can match, or None when it can match any shard
+    if isinstance(condition, Condition):
+        if (
+            condition.column.table != table
+            or condition.column.name != shard_key
+            or hasattr(condition.value, "to_sql")
+        ):
+            return None
+        if condition.condition == "=":
+            return {connection.get_shard_for_key(condition.value)}
+        if condition.condition == "in":
+            return {connection.get_shard_for_key(value) for value in condition.value}
+        return None
+
+    if isinstance(condition, AndCondition):
+        for child in condition.conditions:
+            shards = get_condition_shards(child, table, shard_key)
+            if shards is not None:
+                return shards
+        return None
+
+    if isinstance(condition, OrCondition):
+        shards = set()
+        for child in condition.conditions:
+            child_shards = get_condition_shards(child, table, shard_key)
+            if child_shards is None:
+                return None
+            shards |= child_shards
+        return shards
+
+    return None
+
+
+def get_query_shards(builder: "QueryBuilder", shard_key: str) -> List[str]:
+    table = builder.table or ""
+    shards = get_condition_shards(AndCondition(*builder.conditions), table, shard_key)
+    if shards is None:
+        return connection.get_shard_names()
+    return sorted(shards)
+
+
+def compare_by_order(order_by: List[Any]):
+    def compare(left, right):
+        for column, direction in order_by:
+            left_value = getattr(left, column.name)
+            right_value = getattr(right, column.name)
+            if left_value == right_value:
+                continue
+            # NULLs sort last in ascending order and first in descending order, like Postgres
+            if left_value is None or right_value is None:
+                result = 1 if left_value is None else -1
+            else:
+                result = -1 if left_value < right_value else 1
+            return result if direction == "asc" else -result
+        return 0
+
+    return cmp_to_key(compare)
+
+
+def merge_results(builder: "QueryBuilder", results: List[List[Any]]) -> List[Any]:
+    if len(builder.order_by_conditions) == 0:
+        merged = [row for rows in results for row in rows]
+    else:
+        if any(isinstance(o, str) for o in builder.order_by_conditions):
+            raise Exception("Only model columns can be used to order a query that spans shards")
+        # Every shard returns its rows already sorted so a k-way merge is enough
+        merged = list(heapq.merge(*results, key=compare_by_order(builder.order_by_conditions)))
+
+    if builder.limit_value != None:
+        merged = merged[: builder.limit_value]
+    return merged
+
+
+async def run_insert(builder: "QueryBuilder", shard_key: str) -> List[Any]:
+    if hasattr(builder.data, "named_sql"):
+        raise Exception("INSERT ... SELECT into a sharded table needs on_shard()")
+    rows = builder.data if isinstance(builder.data, list) else [builder.data]
+    rows_by_shard: Dict[str, List[int]] = {}
+    for i, row in enumerate(rows):
+        if shard_key not in row:
+            raise Exception(f"Shard key {shard_key} is required to insert into {builder.table}")
+        rows_by_shard.setdefault(connection.get_shard_for_key(row[shard_key]), []).append(i)
+
+    shard_builders = []
+    for shard, indexes in rows_by_shard.items():
+        shard_builder = copy.copy(builder).on_shard(shard)
+        shard_builder.data = [rows[i] for i in indexes]
+        shard_builders.append(shard_builder)
+
+    results = await asyncio.gather(*[shard_builder.run() for shard_builder in shard_builders])
+    if builder.executes():
+        return sum(results)
+
+    # Return the inserted rows in the order they were provided
+    ordered: List[Any] = [None] * len(rows)
+    for indexes, shard_results in zip(rows_by_shard.values(), results):
+        for i, result in zip(indexes, shard_results):
+            ordered[i] = result
+    return [result for result in ordered if result is not None]
+
+
+async def run_sharded(builder: "QueryBuilder") -> List[Any]:
+    from .query_builder.query_builder import QueryType
+
+    shard_key = get_shard_key(builder.return_as_cls)
+    if shard_key is None:
+        raise Exception(f"{builder.return_as_cls} is not a sharded model")
+
+    if builder.query_type == QueryType.INSERT:
+        return await run_insert(builder, shard_key)
+
+    shards = get_query_shards(builder, shard_key)
+    if len(shards) == 1:
+        return await copy.copy(builder).on_shard(shards[0]).run()
+
+    # Without a shard key every shard has to be queried
+    results = await asyncio.gather(
+        *[copy.copy(builder).on_shard(shard).run() for shard in shards]
+    )
+    if builder.query_type == QueryType.SELECT:
+        return merge_results(builder, results)
+    if builder.executes():
+        return sum(results)
+    return [row for rows in results for row in rows]
@@ -0,0 +1,146 @@
+from typing import Any, Callable, Dict, Iterable, List, Set
+from dataclasses import dataclass
+from logging.handlers import RotatingFileHandler
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import re
+import traceback
+from .instrumentation import QueryEvent
+from .connection import get_connection
+
+PACKAGE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+REDACTED = "<redacted>"
+
+
+@dataclass
+class SlowQuery:
+    event: QueryEvent
+    # Parameters of event.sql after the redaction rules were applied
+    parameters: List[Any]
+    # The first frame outside of actual_orm that ran the query
+    call_site: str | None
+    plan: Any = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "fingerprint": self.event.fingerprint,
+            "sql": self.event.sql,
+            "parameters": [repr(parameter) for parameter in self.parameters],
+            "table": self.event.table,
+            "model": self.event.model,
+            "query_type": self.event.query_type,
+            "shard": self.event.shard,
+            "row_count": self.event.row_count,
+            "total_time": self.event.total_time,
+            "acquire_time": self.event.acquire_time,
+            "execute_time": self.event.execute_time,
+            "call_site": self.call_site,
+            "plan": self.plan,
+        }
+
+
+def get_call_site() -> str | None:
+    for frame in reversed(traceback.extract_stack()):
+        if not os.path.abspath(frame.filename).startswith(PACKAGE_DIRECTORY):
+            return f"{frame.filename}:{frame.lineno} in {frame.name}"
+    return None
+
+
+class SlowQueryLog:
+    # Query listener that records every query slower than threshold seconds,
+    # register it with add_query_listener(SlowQueryLog(...)).
+    #
+    # redact is a list of column names whose values are replaced before
+    # logging, or a function (parameter_name, value) -> value. With explain,
+    # the plan is captured with EXPLAIN (FORMAT JSON) on a separate connection
+    # before the query is written to path and passed to callback.
+    threshold: float
+    redact: Set[str] | Callable[[str, Any], Any]
+    explain: bool
+    callback: Callable[[SlowQuery], Any] | None
+    logger: logging.Logger | None
+    pending: Set[asyncio.Task]
+
+    def __init__(
+        self,
+        threshold: float,
+        redact: Iterable[str] | Callable[[str, Any], Any] = (),
+        explain: bool = False,
+        path: str | None = None,
+        max_bytes: int = 10 * 1024 * 1024,
+        backup_count: int = 5,
+        callback: Callable[[SlowQuery], Any] | None = None,
+    ):
+        self.threshold = threshold
+        self.redact = redact if callable(redact) else set(redact)
+        self.explain = explain
+        self.callback = callback
+        self.pending = set()
+        self.logger = None
+        if path is not None:
+            self.logger = logging.getLogger(f"actual_orm.slow_query.{path}")
+            self.logger.propagate = False
+            self.logger.setLevel(logging.INFO)
+            if len(self.logger.handlers) == 0:
+                self.logger.addHandler(
+                    RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+                )
+
+    def redact_parameter(self, name: str, value: Any) -> Any:
+        if callable(self.redact):
+            return self.redact(name, value)
+        # Parameter names end with _<column>_<nanoid>, followed by _low or
+        # _high for between()
+        for column in self.redact:
+            if re.search(rf"_{re.escape(column)}_[A-Za-z]+(_low|_high)?$", name):
+                return REDACTED
+        return value
+
+    def __call__(self, event: QueryEvent):
+        if event.total_time < self.threshold:
+            return
+
+        slow_query = SlowQuery(
+            event=event,
+            parameters=[
+                self.redact_parameter(name, value)
+                for name, value in zip(event.parameter_names, event.parameters)
+            ],
+            call_site=get_call_site(),
+        )
+        if not self.explain:
+            self.record(slow_query)
+            return
+
+        # Run EXPLAIN in an empty context so it doesn't reuse a connection
+        # bound by the caller's connection_scope
+        task = asyncio.get_running_loop().create_task(
+            self.explain_and_record(slow_query), context=contextvars.Context()
+        )
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+    async def explain_and_record(self, slow_query: SlowQuery):
+        event = slow_query.event
+        try:
+            async with get_connection(shard=event.shard) as conn:
+                plan = await conn.fetchval(f"EXPLAIN (FORMAT JSON) {event.sql}", *event.parameters)
+            slow_query.plan = json.loads(plan)
+        except Exception as e:
+            slow_query.plan = {"error": str(e)}
+        self.record(slow_query)
+
+    def record(self, slow_query: SlowQuery):
+        if self.logger is not None:
+            self.logger.info(json.dumps(slow_query.to_dict(), default=str))
+        if self.callback is not None:
+            self.callback(slow_query)
+
+    async def flush(self):
+        # Waits for the EXPLAINs that are still running
+        if len(self.pending) > 0:
+            await asyncio.gather(*self.pending)
@@ -0,0 +1,117 @@
+from typing import Any, Awaitable, Callable, Dict, List
+from dataclasses import dataclass, asdict
+from statistics import median
+from time import perf_counter
+import json
+import platform
+import sys
+
+
+@dataclass
+class BenchmarkResult:
+    name: str
+    iterations: int
+    # Seconds per iteration
+    mean: float
+    median: float
+    p95: float
+    min: float
+
+    @property
+    def ops_per_second(self):
+        return 1 / self.median if self.median > 0 else 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {**asdict(self), "ops_per_second": self.ops_per_second}
+
+
+@dataclass
+class Regression:
+    name: str
+    baseline: float
+    current: float
+    tolerance: float
+
+    @property
+    def slowdown(self):
+        return self.current / self.baseline - 1
+
+
+def summarize(name: str, timings: List[float]) -> BenchmarkResult:
+    timings = sorted(timings)
+    return BenchmarkResult(
+        name=name,
+        iterations=len(timings),
+        mean=sum(timings) / len(timings),
+        median=median(timings),
+        p95=timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+        min=timings[0],
+    )
+
+
+def measure(name: str, fn: Callable[[], Any], iterations: int, warmup: int = 10) -> BenchmarkResult:
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(iterations):
+        start = perf_counter()
+        fn()
+        timings.append(perf_counter() - start)
+    return summarize(name, timings)
+
+
+async def measure_async(
+    name: str, fn: Callable[[], Awaitable[Any]], iterations: int, warmup: int = 10
+) -> BenchmarkResult:
+    for _ in range(warmup):
+        await fn()
+    timings = []
+    for _ in range(iterations):
+        start = perf_counter()
+        await fn()
+        timings.append(perf_counter() - start)
+    return summarize(name, timings)
+
+
+def write_results(path: str, results: List[BenchmarkResult]):
+    with open(path, "w") as file:
+        json.dump(
+            {
+                "python": sys.version.split()[0],
+                "platform": platform.platform(),
+                "results": {result.name: result.to_dict() for result in results},
+            },
+            file,
+            indent=2,
+        )
+
+
+def read_results(path: str) -> Dict[str, Dict[str, Any]]:
+    with open(path) as file:
+        return json.load(file)["results"]
+
+
+def find_regressions(
+    results: List[BenchmarkResult],
+    baseline: Dict[str, Dict[str, Any]],
+    tolerance: float,
+    tolerances: Dict[str, float] | None = None,
+) -> List[Regression]:
+    # Compares medians, a benchmark regressed when it got more than its
+    # tolerance slower. Benchmarks missing from the baseline are skipped.
+    regressions = []
+    for result in results:
+        if result.name not in baseline:
+            continue
+        allowed = (tolerances or {}).get(result.name, tolerance)
+        baseline_median = baseline[result.name]["median"]
+        if result.median > baseline_median * (1 + allowed):
+            regressions.append(
+                Regression(
+                    name=result.name,
+                    baseline=baseline_median,
+                    current=result.median,
+                    tolerance=allowed,
+                )
+            )
+    return regressions
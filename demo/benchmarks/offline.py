@@ -0,0 +1,91 @@
+from typing import List
+from datetime import datetime, timezone
+from actual_orm.query_builder.query_builder import OrderByDirection
+from actual_orm.query_builder.conditions import AndCondition
+from demo.database.models.application import Application
+from demo.database.models.content import Content, ContentType
+from .harness import BenchmarkResult, measure
+
+NOW = datetime.now(timezone.utc)
+
+
+def content_record(i: int):
+    return {
+        "id": i,
+        "title": f"title {i}",
+        "external_id": f"external {i}",
+        "type": ContentType.text,
+        "hash": f"{i:064}",
+        "full_text": "text " * 50,
+        "context_id": f"context {i % 10}",
+        "created_at": NOW,
+        "updated_at": NOW,
+    }
+
+
+def content_data(i: int):
+    record = content_record(i)
+    del record["id"], record["created_at"], record["updated_at"]
+    return record
+
+
+def compile_select():
+    return (
+        Content.builder()
+        .select()
+        .where(
+            AndCondition(
+                Content.columns.context_id == "context 1",
+                Content.columns.type == ContentType.text,
+            )
+        )
+        .order_by((Content.columns.created_at, OrderByDirection.DESC))
+        .limit(20)
+        .sql()
+    )
+
+
+def compile_join():
+    return (
+        Application.builder()
+        .select()
+        .join("content", Content.columns.context_id == Application.columns.external_id)
+        .where(Application.columns.id == 1)
+        .sql()
+    )
+
+
+def compile_insert(rows: List[dict]):
+    return lambda: Content.builder().insert("content", rows).sql()
+
+
+def compile_update():
+    return (
+        Content.builder()
+        .update("content", {"title": "title", "full_text": "text"})
+        .where(Content.columns.id == 1)
+        .sql()
+    )
+
+
+def compile_delete():
+    return Content.builder().delete("content").where(Content.columns.id == 1).sql()
+
+
+def hydrate(count: int):
+    builder = Content.builder().select().return_as(Content)
+    records = [content_record(i) for i in range(count)]
+    return lambda: builder.hydrate(records)
+
+
+def run_offline(iterations: int) -> List[BenchmarkResult]:
+    return [
+        measure("compile.select", compile_select, iterations),
+        measure("compile.select_join", compile_join, iterations),
+        measure("compile.insert_1", compile_insert([content_data(0)]), iterations),
+        measure("compile.insert_100", compile_insert([content_data(i) for i in range(100)]), iterations // 10 or 1),
+        measure("compile.update", compile_update, iterations),
+        measure("compile.delete", compile_delete, iterations),
+        measure("hydrate.content_1", hydrate(1), iterations),
+        measure("hydrate.content_1000", hydrate(1000), iterations // 10 or 1),
+    ]
@@ -0,0 +1,140 @@
+from typing import List
+import asyncio
+import asyncpg
+import actual_orm.cli.utils as utils
+from actual_orm import configure, close, PoolOptions
+from actual_orm.query_builder.query_builder import OrderByDirection
+from demo.database.models.content import Content
+from .harness import BenchmarkResult, measure_async
+from .offline import content_data
+
+DB_NAME = "actual_orm_benchmark"
+SEED_ROWS = 10_000
+
+
+async def create_database(server_url: str):
+    conn = await asyncpg.connect(server_url)
+    await conn.execute(f"DROP DATABASE IF EXISTS {DB_NAME}")
+    await conn.execute(f"CREATE DATABASE {DB_NAME}")
+    await conn.close()
+    await utils.run_migrations(server_url + DB_NAME, package="demo.database")
+
+
+async def seed():
+    for start in range(0, SEED_ROWS, 1000):
+        await Content.create_many([content_data(i) for i in range(start, start + 1000)])
+
+
+def get_by_id():
+    counter = iter(range(1, 10**9))
+
+    async def run():
+        await Content.get(Content.columns.id == next(counter) % SEED_ROWS + 1)
+
+    return run
+
+
+async def query_page():
+    await Content.query(
+        Content.columns.context_id == "context 3",
+        order_by=[(Content.columns.id, OrderByDirection.DESC)],
+        limit=20,
+    )
+
+
+def create_many(batch_size: int):
+    counter = iter(range(SEED_ROWS, 10**9, batch_size))
+
+    async def run():
+        start = next(counter)
+        await Content.create_many([content_data(i) for i in range(start, start + batch_size)])
+
+    return run
+
+
+async def upsert():
+    await Content.upsert(
+        Content.columns.external_id == "external 1",
+        create=content_data(1),
+        update={"title": "upserted"},
+    )
+
+
+def query_many(count: int):
+    conditions = [Content.columns.context_id == f"context {i}" for i in range(count)]
+
+    async def run():
+        await Content.query_many(conditions, limit=20)
+
+    return run
+
+
+def buffered_create(concurrency: int):
+    counter = iter(range(10**8, 10**9))
+    writer = Content.buffered_writer(max_rows=concurrency)
+
+    async def run():
+        await asyncio.gather(*[writer.create(content_data(next(counter))) for _ in range(concurrency)])
+
+    return run
+
+
+def concurrent_get(concurrency: int):
+    get = get_by_id()
+
+    async def run():
+        await asyncio.gather(*[get() for _ in range(concurrency)])
+
+    return run
+
+
+async def run_queries(prefix: str, iterations: int, pool_size: int) -> List[BenchmarkResult]:
+    results = [
+        await measure_async(f"{prefix}.get", get_by_id(), iterations),
+        await measure_async(f"{prefix}.query", query_page, iterations),
+    ]
+    for batch_size in (1, 10, 100, 1000):
+        results.append(
+            await measure_async(
+                f"{prefix}.create_many_{batch_size}",
+                create_many(batch_size),
+                max(1, iterations // batch_size),
+            )
+        )
+    results.append(await measure_async(f"{prefix}.upsert", upsert, iterations))
+    results.append(await measure_async(f"{prefix}.query_many_10", query_many(10), max(1, iterations // 10)))
+    results.append(
+        await measure_async(f"{prefix}.buffered_create_100", buffered_create(100), max(1, iterations // 100))
+    )
+    # More tasks than pooled connections, so acquires have to wait
+    concurrency = pool_size * 5
+    results.append(
+        await measure_async(
+            f"{prefix}.concurrent_get_{concurrency}",
+            concurrent_get(concurrency),
+            max(1, iterations // 10),
+        )
+    )
+    return results
+
+
+async def run_online(
+    server_url: str, iterations: int, pool_size: int, pgbouncer_url: str | None = None
+) -> List[BenchmarkResult]:
+    await create_database(server_url)
+    configure(server_url + DB_NAME, PoolOptions(min_size=pool_size, max_size=pool_size))
+    try:
+        await seed()
+        results = await run_queries("db", iterations, pool_size)
+    finally:
+        await close()
+    if pgbouncer_url == None:
+        return results
+
+    # The same queries through PgBouncer in transaction pooling mode, it has
+    # to serve the benchmark database under the same name
+    configure(pgbouncer_url + DB_NAME, PoolOptions(min_size=pool_size, max_size=pool_size), pgbouncer=True)
+    try:
+        return results + await run_queries("pgbouncer", iterations, pool_size)
+    finally:
+        await close()
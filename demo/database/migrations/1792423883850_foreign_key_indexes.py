@@ -0,0 +1,7 @@
+# Migration Name: foreign_key_indexes
+# Created at: 1792423883850
+from asyncpg import Connection
+
+async def migrate(conn: Connection):
+    await conn.execute("CREATE INDEX idx_api_keys_index_application_id ON api_keys (application_id)")
+    await conn.execute("CREATE INDEX idx_content_owners_index_owner_id ON content_owners (owner_id)")
@@ -0,0 +1,178 @@
+import pytest
+import pytest_asyncio
+import asyncpg
+import actual_orm.cli.utils as utils
+from demo.database.models.content import Content, ContentType
+from actual_orm import configure, close, get_connection, RetryPolicy
+from actual_orm.connection import get_shard_for_key
+from actual_orm.query_builder.query_builder import OrderByDirection
+from actual_orm.query_builder import AndCondition, RawSql
+from .conftest import DATABASE_URL, DB_NAME
+
+pytestmark = pytest.mark.asyncio(loop_scope="module")
+
+SHARDS = {
+    "shard_a": DATABASE_URL + DB_NAME + "_shard_a",
+    "shard_b": DATABASE_URL + DB_NAME + "_shard_b",
+}
+
+
+@pytest_asyncio.fixture(scope="module")
+async def shards(db):
+    db_conn = await asyncpg.connect(DATABASE_URL)
+    for url in SHARDS.values():
+        name = url.rsplit("/", 1)[1]
+        await db_conn.execute(f"DROP DATABASE IF EXISTS {name}")
+        await db_conn.execute(f"CREATE DATABASE {name}")
+    await db_conn.close()
+
+    for url in SHARDS.values():
+        await utils.run_migrations(url)
+
+    await close()
+    configure(DATABASE_URL + DB_NAME, shards=SHARDS)
+    Content.__shard_key__ = "context_id"
+    yield
+    del Content.__shard_key__
+    await close()
+    configure(DATABASE_URL + DB_NAME)
+
+
+def content(context_id: str, title: str):
+    return {
+        "title": title,
+        "external_id": title,
+        "type": ContentType.text,
+        "hash": title,
+        "full_text": title,
+        "context_id": context_id,
+    }
+
+
+def context_ids_by_shard():
+    # Find a context id that lands on each shard
+    found = {}
+    i = 0
+    while len(found) < len(SHARDS):
+        found.setdefault(get_shard_for_key(f"context_{i}"), f"context_{i}")
+        i += 1
+    return found
+
+
+async def test_create_routes_by_shard_key(shards):
+    for shard, context_id in context_ids_by_shard().items():
+        created = await Content.create(content(context_id, f"routed_{shard}"))
+
+        conn = await asyncpg.connect(SHARDS[shard])
+        row = await conn.fetchrow("SELECT * FROM content WHERE id = $1", created.id)
+        await conn.close()
+        assert row["context_id"] == context_id
+
+        found = await Content.get(
+            Content.columns.context_id == context_id, Content.columns.id == created.id
+        )
+        assert found != None
+        assert found.title == f"routed_{shard}"
+
+    async with get_connection() as conn:
+        assert await conn.fetchval("SELECT COUNT(*) FROM content") == 0
+
+
+async def test_query_fans_out_and_merges(shards):
+    context_ids = list(context_ids_by_shard().values())
+    await Content.create_many(
+        [
+            content(context_ids[0], "merge_1"),
+            content(context_ids[1], "merge_2"),
+            content(context_ids[0], "merge_3"),
+            content(context_ids[1], "merge_4"),
+        ]
+    )
+
+    results = await Content.query(
+        condition=Content.columns.external_id.in_(["merge_1", "merge_2", "merge_3", "merge_4"]),
+        order_by=[(Content.columns.title, OrderByDirection.DESC)],
+        limit=3,
+    )
+    assert [result.title for result in results] == ["merge_4", "merge_3", "merge_2"]
+
+
+async def test_batches_walk_every_shard(shards):
+    context_ids = list(context_ids_by_shard().values())
+    await Content.create_many(
+        [content(context_id, "batched") for context_id in context_ids for _ in range(3)]
+    )
+
+    deleted = await Content.delete_in_batches(Content.columns.external_id == "batched", batch_size=2)
+    assert deleted == 6
+    assert await Content.query(Content.columns.external_id == "batched") == []
+
+
+async def test_sharded_reads_are_retried(shards):
+    for url in SHARDS.values():
+        conn = await asyncpg.connect(url)
+        # Fails with a serialization failure on the first call
+        await conn.execute("CREATE SEQUENCE IF NOT EXISTS retry_calls")
+        await conn.execute(
+            """
+            CREATE OR REPLACE FUNCTION fail_first() RETURNS int8 AS $$
+            BEGIN
+                IF nextval('retry_calls') = 1 THEN
+                    RAISE EXCEPTION 'serialization failure' USING ERRCODE = '40001';
+                END IF;
+                RETURN 0;
+            END
+            $$ LANGUAGE plpgsql VOLATILE
+            """
+        )
+        await conn.close()
+
+    events = []
+    query = (
+        Content.builder()
+        .select()
+        .where(Content.columns.id != RawSql("fail_first()"))
+        .retry(RetryPolicy(base_delay=0, on_retry=events.append))
+    )
+    await query.run()
+    assert sorted(event.attempt for event in events) == [1] * len(SHARDS)
+
+
+async def test_self_writes_stay_on_their_shard(shards):
+    context_ids = context_ids_by_shard()
+    # The same primary key on every shard
+    rows = [
+        await Content.create({**content(context_id, f"self_{shard}"), "id": 100_000})
+        for shard, context_id in context_ids.items()
+    ]
+
+    rows[0].title = "self updated"
+    await rows[0].update_self()
+    await rows[0].delete_self()
+
+    assert await Content.get(Content.columns.context_id == rows[0].context_id, Content.columns.id == 100_000) == None
+    for row in rows[1:]:
+        found = await Content.get(Content.columns.context_id == row.context_id, Content.columns.id == 100_000)
+        assert found.title == row.title
+
+
+async def test_upsert_runs_on_the_row_shard(shards):
+    for shard, context_id in context_ids_by_shard().items():
+        where = AndCondition(Content.columns.context_id == context_id, Content.columns.external_id == "upserted")
+        created = await Content.upsert(where, create=content(context_id, "upserted"), update={"title": "updated"})
+        updated = await Content.upsert(where, create=content(context_id, "upserted"), update={"title": "updated"})
+        assert updated.id == created.id and updated.title == "updated"
+
+        conn = await asyncpg.connect(SHARDS[shard])
+        assert await conn.fetchval("SELECT title FROM content WHERE id = $1", created.id) == "updated"
+        await conn.close()
+
+    async with get_connection() as conn:
+        assert await conn.fetchval("SELECT COUNT(*) FROM content WHERE external_id = 'upserted'") == 0
+
+    with pytest.raises(Exception, match="Shard key context_id is required"):
+        await Content.upsert(
+            Content.columns.external_id == "upserted",
+            create={"title": "upserted"},
+            update={"title": "updated"},
+        )
@@ -2,8 +2,42 @@ import pytest
 import datetime
 from demo.database.models.application import Application
 from demo.database.models.owner import Owner
-from actual_orm.query_builder.query_builder import OrderByDirection
-from actual_orm import get_connection
+from demo.database.models.api_key import ApiKey
+from actual_orm.query_builder.query_builder import OrderByDirection, QueryBuilder, get_parameter_names
+from actual_orm.db import coalesce, now
+from actual_orm.query_builder import AndCondition, OrCondition, NotCondition, Condition, RawSql, exists
+from actual_orm.query_builder.model_column import ModelColumn
+from actual_orm import (
+    batch,
+    parallel,
+    RetryPolicy,
+    retry_transaction,
+    add_retry_listener,
+    remove_retry_listener,
+    get_connection,
+    connection_scope,
+    start_transaction,
+    configure,
+    close,
+    PoolOptions,
+    ReplicaSelection,
+    on_connect,
+    prepare_on_connect,
+    configure_pool_metrics,
+    pool_stats,
+    add_pool_listener,
+    remove_pool_listener,
+    add_query_listener,
+    remove_query_listener,
+    SlowQueryLog,
+)
+import json
+import asyncpg
+import asyncio
+import actual_orm.connection
+from actual_orm.cli.utils.model_schema import get_model_schema
+from actual_orm.cli.utils.index_advisor import WorkloadQuery, suggest_indexes, find_redundant_indexes
+from .conftest import DATABASE_URL, DB_NAME
 
 pytestmark = pytest.mark.asyncio(loop_scope="module")
 
@@ -143,6 +177,520 @@ async def test_join(db):
     assert owners[0].id == owner.id
 
 
+async def test_operators(db):
+    apps = await Application.create_many(
+        [{"external_id": f"operators_{i}", "title": f"Title {i}"} for i in range(3)]
+    )
+    ids = [app.id for app in apps]
+
+    async def query_ids(condition):
+        results = await Application.query(
+            AndCondition(Application.columns.id.in_(ids), condition),
+            order_by=[(Application.columns.id, OrderByDirection.ASC)],
+        )
+        return [app.id for app in results]
+
+    assert await query_ids(Application.columns.id != ids[0]) == ids[1:]
+    assert await query_ids(Application.columns.id <= ids[1]) == ids[:2]
+    assert await query_ids(Application.columns.id >= ids[1]) == ids[1:]
+    assert await query_ids(Application.columns.id.between(ids[0], ids[1])) == ids[:2]
+    assert await query_ids(Application.columns.id.not_in([ids[0]])) == ids[1:]
+    assert await query_ids(Application.columns.external_id.like("operators_%")) == ids
+    assert await query_ids(Application.columns.title.ilike("title 1")) == [ids[1]]
+    assert await query_ids(Application.columns.title == None) == []
+    assert await query_ids(Application.columns.title.is_not_null()) == ids
+
+    # Negation rewrites the operators instead of wrapping them in NOT
+    assert await query_ids(~(Application.columns.id < ids[1])) == ids[1:]
+    assert await query_ids(
+        ~OrCondition(Application.columns.id == ids[0], Application.columns.id == ids[2])
+    ) == [ids[1]]
+    sql, _ = (~AndCondition(Application.columns.id.in_([1]), Application.columns.title == None)).to_sql()
+    assert sql.startswith("(applications.id <> ALL(:condition_applications_id_")
+    assert sql.endswith("OR applications.title IS NOT NULL)")
+
+    sql, parameters = Application.columns.title.json_contains({"a": 1}).to_sql()
+    assert "@> CAST(:condition_applications_title_" in sql
+    assert list(parameters.values()) == ['{"a": 1}']
+    assert NotCondition(Application.columns.title.has_key("a")).to_sql()[0].startswith(
+        "NOT (applications.title ? :"
+    )
+
+
+async def test_large_in_lists(db, monkeypatch):
+    apps = await Application.create_many(
+        [{"external_id": f"in_list_{i}", "title": "title"} for i in range(5)]
+    )
+    ids = [app.id for app in apps]
+
+    sql, _ = Application.columns.id.in_(ids, type="int8").to_sql()
+    assert "= ANY(CAST(:condition_applications_id_" in sql and sql.endswith(" AS int8[]))")
+    assert len(await Application.query(Application.columns.id.in_(ids, type="int8"))) == 5
+
+    # Lists above the threshold are COPY'd into a temp table and joined
+    monkeypatch.setattr(actual_orm.connection, "in_list_threshold", 2)
+    sql, parameters = Application.columns.id.in_(ids).to_sql()
+    [table] = parameters.values()
+    assert sql == f"applications.id IN (SELECT value FROM {table.name})"
+    assert table.type == "int8"
+
+    assert {app.id for app in await Application.query(Application.columns.id.in_(ids))} == set(ids)
+    updated = await Application.update(
+        {"title": "updated"},
+        AndCondition(Application.columns.id.in_(ids), Application.columns.id.not_in(ids[:3])),
+    )
+    assert {app.id for app in updated} == set(ids[3:])
+
+    # On both sides of the threshold a NULL in the list matches nothing, and
+    # not_in() with a NULL in the list is never true, like <> ALL()
+    for values in ([ids[0], None], [ids[0], None, None]):
+        assert [app.id for app in await Application.query(Application.columns.id.in_(values))] == [ids[0]]
+        assert await Application.query(
+            AndCondition(Application.columns.id.in_(ids), Application.columns.id.not_in(values))
+        ) == []
+
+    await Application.delete(Application.columns.id.in_(ids))
+    assert await Application.query(Application.columns.id.in_(ids, type="int8")) == []
+
+
+async def test_batches(db, monkeypatch):
+    apps = await Application.create_many(
+        [{"external_id": "batches", "title": "title"} for _ in range(7)]
+    )
+    ids = [app.id for app in apps]
+    condition = Application.columns.external_id == "batches"
+
+    progress = []
+    updated = await Application.update_in_batches(
+        {"title": "updated"}, condition, batch_size=3, on_progress=lambda p: progress.append(p.rows)
+    )
+    assert updated == 7
+    assert progress == [3, 6, 7]
+    assert {app.title for app in await Application.query(condition)} == {"updated"}
+
+    # Resumes after the given key
+    deleted = await Application.delete_in_batches(condition, batch_size=3, after=ids[1], skip_locked=True)
+    assert deleted == 5
+    assert sorted(app.id for app in await Application.query(condition)) == ids[:2]
+
+    # Locked rows are skipped and reported
+    locked = Application.columns.external_id == "locked"
+    apps = await Application.create_many([{"external_id": "locked", "title": "title"} for _ in range(3)])
+    locked_ids = [app.id for app in apps]
+    async with get_connection() as other:
+        async with other.transaction():
+            await other.execute("SELECT 1 FROM applications WHERE id = $1 FOR UPDATE", locked_ids[0])
+            progress = []
+            deleted = await Application.delete_in_batches(
+                locked, batch_size=1, skip_locked=True, on_progress=progress.append
+            )
+    assert deleted == 2
+    assert progress[-1].skipped == 1
+    assert [app.id for app in await Application.query(locked)] == locked_ids[:1]
+
+    # The select of every batch loads the temp tables of long in_() lists too
+    monkeypatch.setattr(actual_orm.connection, "in_list_threshold", 1)
+    assert await Application.delete_in_batches(Application.columns.id.in_(ids), batch_size=1) == 2
+
+    # Every batch has to commit on its own
+    with pytest.raises(Exception, match="commits on its own"):
+        async with start_transaction():
+            await Application.delete_in_batches(condition)
+
+    # Batches run through the query builder, so listeners see them
+    await Application.create_many([{"external_id": "batches", "title": "title"} for _ in range(2)])
+    events = []
+    listener = add_query_listener(events.append)
+    try:
+        assert await Application.delete_in_batches(condition, batch_size=1) == 2
+    finally:
+        remove_query_listener(listener)
+    assert [event.query_type for event in events] == ["select", "delete", "select", "delete", "select"]
+
+
+async def test_update_expressions(db):
+    app = await Application.create(
+        {
+            "external_id": "expressions",
+            "title": "title",
+            "updated_at": datetime.datetime.fromisoformat("2024-11-13T00:00:00+00:00"),
+        }
+    )
+
+    # updated_at columns are set to NOW() without being passed
+    [updated] = await Application.update(
+        {"external_id": coalesce(None, Application.columns.title)},
+        AndCondition(
+            Application.columns.id == app.id,
+            Application.columns.created_at <= now(),
+            Application.columns.id < Application.columns.id + 1,
+        ),
+    )
+    assert updated.external_id == "title"
+    assert updated.updated_at > app.updated_at
+
+    sql, parameters = QueryBuilder().update("applications", {"id": Application.columns.id * 2 + 1}).where(
+        Application.columns.id == app.id
+    ).sql()
+    assert sql.startswith("UPDATE applications SET id = ((applications.id * $1) + $2) WHERE")
+    assert parameters == [2, 1, app.id]
+
+    assert get_parameter_names("SELECT :a::int8, :b, :a") == ["a", "b"]
+
+
+async def test_returning(db):
+    assert await Application.create({"external_id": "returning", "title": "title"}, returning=False) == 1
+    [record] = await Application.create_many(
+        [{"external_id": "returning", "title": "title"}], returning="pk"
+    )
+    assert list(record.keys()) == ["id"]
+
+    condition = Application.columns.external_id == "returning"
+    assert await Application.update({"title": "updated"}, condition, returning=False) == 2
+    records = await Application.update({"title": "updated"}, condition, returning=["id", "title"])
+    assert [dict(record)["title"] for record in records] == ["updated", "updated"]
+
+    where = AndCondition(condition, Application.columns.id == record["id"])
+    assert await Application.upsert(where, {}, {"title": "upserted"}, returning=False) == 1
+    upserted = await Application.upsert(where, {}, {}, returning=["title"])
+    assert upserted["title"] == "upserted"
+
+
+async def test_subqueries(db):
+    [with_keys, without_keys] = await Application.create_many(
+        [{"external_id": "subqueries", "title": "with keys"}, {"external_id": "subqueries", "title": "without keys"}]
+    )
+    await ApiKey.create(
+        {"key": "00000000-0000-0000-0000-000000000042", "active": True, "application_id": with_keys.id}
+    )
+    owner = await Owner.create({"external_id": "subqueries", "application_id": with_keys.id})
+    apps = Application.columns.external_id == "subqueries"
+    active_keys = ApiKey.builder().select().where(
+        AndCondition(ApiKey.columns.application_id == Application.columns.id, ApiKey.columns.active == True)
+    )
+
+    [app] = await Application.query(AndCondition(apps, ~exists(active_keys)))
+    assert app.id == without_keys.id
+    [app] = await Application.query(AndCondition(apps, exists(active_keys)))
+    assert app.id == with_keys.id
+
+    owner_apps = Owner.builder().select(columns=["application_id"]).where(Owner.columns.id == owner.id)
+    [app] = await Application.query(AndCondition(apps, Application.columns.id.in_(owner_apps)))
+    assert app.id == with_keys.id
+
+    # INSERT ... SELECT copies rows in one statement
+    copies = await QueryBuilder().insert(
+        "applications",
+        QueryBuilder().select("applications", ["external_id", "title"]).where(apps),
+    ).return_as(Application).run()
+    assert sorted(app.title for app in copies) == ["with keys", "without keys"]
+
+    # A data-modifying CTE, parameters of every builder are numbered once
+    deleted = QueryBuilder().delete("applications").where(
+        AndCondition(apps, Application.columns.id.in_([app.id for app in copies]))
+    ).returning(["id"])
+    builder = QueryBuilder().select("deleted", ["id"]).with_("deleted", deleted).where(
+        Condition(column=ModelColumn(table="deleted", name="id"), condition=">", value=0)
+    )
+    sql, parameters = builder.sql()
+    assert sql == (
+        "WITH deleted AS (DELETE FROM applications WHERE (applications.external_id = $1 AND applications.id = ANY($2)) RETURNING id) "
+        "SELECT deleted.id FROM deleted WHERE deleted.id > $3"
+    )
+    assert parameters == ["subqueries", [app.id for app in copies], 0]
+    assert not builder.is_readonly()
+    assert len(await builder.run()) == 2
+    assert len(await Application.query(apps)) == 2
+
+
+async def test_related_models(db):
+    app = await Application.create({"external_id": "related", "title": "related"})
+    owner = await Owner.create({"external_id": "related", "application_id": app.id})
+
+    [(selected_owner, selected_app)] = (
+        await Owner.builder()
+        .select()
+        .join(Application.__table_name__, Application.columns.id == Owner.columns.application_id)
+        .where(Owner.columns.id == owner.id)
+        .return_as(Owner, Application)
+        .run()
+    )
+    assert selected_owner == owner
+    assert selected_app == app
+
+    # Joined through the foreign key, LEFT JOIN misses become None
+    [selected_app] = (
+        await Application.builder()
+        .select()
+        .left_join(
+            Owner.__table_name__,
+            AndCondition(Owner.columns.application_id == Application.columns.id, Owner.columns.id == -1),
+        )
+        .where(Application.columns.id == app.id)
+        .return_as(Application, Owner)
+        .run()
+    )
+    assert selected_app == (app, None)
+
+    [selected_owner] = (
+        await Owner.builder().select().select_related(Application).where(Owner.columns.id == owner.id).run()
+    )
+    assert selected_owner.application == app
+
+
+async def test_batch(db):
+    app = await Application.create({"external_id": "batch", "title": "batch"})
+    owner = await Owner.create({"external_id": "batch", "application_id": app.id})
+
+    events = []
+    listener = add_query_listener(events.append)
+    try:
+        apps, owners, missing, records = await batch(
+            Application.builder().select().where(Application.columns.id == app.id),
+            Owner.builder().select().select_related(Application).where(Owner.columns.id == owner.id),
+            Owner.builder().select().where(Owner.columns.id == -1),
+            QueryBuilder().select("owners", ["id", "external_id"]).where(Owner.columns.id == owner.id),
+        )
+    finally:
+        remove_query_listener(listener)
+
+    assert apps == [app]
+    assert owners == [owner] and owners[0].application == app
+    assert missing == []
+    assert records == [{"id": owner.id, "external_id": "batch"}]
+    [event] = events
+    assert event.query_type == "batch"
+    assert event.row_count == 3
+
+
+async def test_parallel(db):
+    apps = await Application.create_many(
+        [{"external_id": f"parallel {i}", "title": "parallel"} for i in range(4)]
+    )
+
+    # Results come back in order, scoped connections aren't shared by the tasks
+    async with connection_scope():
+        results = await Application.query_many(
+            [Application.columns.external_id == f"parallel {i}" for i in reversed(range(4))],
+            max_concurrency=2,
+        )
+    assert results == [[app] for app in reversed(apps)]
+
+    # Builders and awaitables can be mixed
+    app, missing = await parallel(
+        [
+            Application.get(Application.columns.id == apps[0].id),
+            Owner.builder().select().where(Owner.columns.id == -1),
+        ]
+    )
+    assert app == apps[0] and missing == []
+
+    started = []
+
+    async def slow():
+        started.append(True)
+        await asyncio.sleep(10)
+
+    async def fail():
+        raise Exception("failed")
+
+    # A failure cancels the other queries and raises the original exception
+    with pytest.raises(Exception, match="failed"):
+        await asyncio.wait_for(parallel([slow(), fail()]), timeout=5)
+    assert started == [True]
+
+
+async def test_buffered_writer(db):
+    writer = Application.buffered_writer(max_rows=3, max_latency_ms=10)
+    events = []
+    listener = add_query_listener(events.append)
+    try:
+        apps = await asyncio.gather(
+            *[writer.create({"external_id": f"buffered {i}", "title": "buffered"}) for i in range(7)]
+        )
+    finally:
+        remove_query_listener(listener)
+    # Two full batches and the remaining row after max_latency_ms
+    assert [app.external_id for app in apps] == [f"buffered {i}" for i in range(7)]
+    assert [event.row_count for event in events] == [3, 3, 1]
+
+    # Only the caller whose row failed gets the error
+    failed = await asyncio.gather(
+        writer.create({"external_id": "buffered", "title": "buffered"}),
+        writer.create({"external_id": "buffered", "title": None}),
+        writer.create({"external_id": "buffered", "title": "buffered"}),
+        return_exceptions=True,
+    )
+    assert isinstance(failed[0], Application) and isinstance(failed[2], Application)
+    assert isinstance(failed[1], asyncpg.NotNullViolationError)
+
+    # close() writes whatever is still buffered
+    writer = Application.buffered_writer(max_rows=100, max_latency_ms=60_000)
+    pending = asyncio.create_task(writer.create({"external_id": "buffered close", "title": "buffered"}))
+    await asyncio.sleep(0)
+    await close()
+    assert (await pending).external_id == "buffered close"
+    with pytest.raises(Exception, match="closed"):
+        await writer.create({"external_id": "buffered close", "title": "buffered"})
+
+
+async def test_claim(db):
+    apps = await Application.create_many(
+        [{"external_id": "queued", "title": f"job {i}"} for i in range(5)]
+    )
+    query = Application.builder().select().where(Application.columns.id == 1)
+    assert query.for_update(skip_locked=True, of=["applications"]).sql()[0].endswith(
+        " FOR UPDATE OF applications SKIP LOCKED"
+    )
+    assert not query.is_readonly()
+    assert query.for_share(nowait=True).sql()[0].endswith(" FOR SHARE NOWAIT")
+
+    queued = Application.columns.external_id == "queued"
+    order = [(Application.columns.id, OrderByDirection.ASC)]
+    async with start_transaction():
+        first = await Application.claim({"external_id": "running"}, queued, limit=2, order_by=order)
+        # UPDATE ... RETURNING doesn't return the rows in order_by order
+        assert sorted(app.id for app in first) == [app.id for app in apps[:2]]
+
+        # parallel() runs on other connections, they skip the rows this
+        # transaction claimed and fail on them with nowait
+        [second] = await parallel(
+            [Application.claim({"external_id": "running"}, queued, limit=2, order_by=order)]
+        )
+        assert sorted(app.id for app in second) == [app.id for app in apps[2:4]]
+        locked = Application.builder().select().where(Application.columns.id == apps[0].id)
+        with pytest.raises(asyncpg.LockNotAvailableError):
+            await parallel([locked.for_update(nowait=True)])
+
+
+def sleeping(seconds: float):
+    # A condition that takes seconds to evaluate, the subquery runs once
+    return Application.columns.id != RawSql(f"(SELECT 0 FROM pg_sleep({seconds}))")
+
+
+async def test_timeouts(db):
+    with pytest.raises(TimeoutError):
+        await Application.query(sleeping(1), timeout=0.1)
+    with pytest.raises(TimeoutError):
+        await Application.get(sleeping(1), timeout=0.1)
+    with pytest.raises(TimeoutError):
+        await Application.builder().select().where(sleeping(1)).timeout(0.1).explain(analyze=True)
+
+    async with start_transaction() as conn:
+        # Set with SET LOCAL, a timed out query rolls back to its savepoint
+        with pytest.raises((TimeoutError, asyncpg.QueryCanceledError)):
+            await Application.query(sleeping(1), timeout=0.1)
+        await Application.query(sleeping(0), timeout=5)
+        assert await conn.fetchval("SHOW statement_timeout") == "0"
+
+    # Cancelling the awaiting task cancels the query on the server
+    task = asyncio.create_task(Application.query(sleeping(5)))
+    await asyncio.sleep(0.2)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    async with get_connection() as conn:
+        running = await conn.fetchval(
+            "SELECT count(*) FROM pg_stat_activity WHERE query LIKE '%pg_sleep(5)%' AND pid <> pg_backend_pid()"
+        )
+    assert running == 0
+
+    await close()
+    configure(DATABASE_URL + DB_NAME, statement_timeout=0.1)
+    try:
+        with pytest.raises(asyncpg.QueryCanceledError):
+            await Application.query(sleeping(1))
+        # A longer timeout outlasts the default
+        await Application.query(sleeping(0.2), timeout=5)
+    finally:
+        await close()
+        configure(DATABASE_URL + DB_NAME)
+
+
+async def test_retries(db):
+    async with get_connection() as conn:
+        # Fails with a serialization failure every other call
+        await conn.execute("CREATE SEQUENCE IF NOT EXISTS retry_calls")
+        await conn.execute(
+            """
+            CREATE OR REPLACE FUNCTION fail_every_other() RETURNS int8 AS $$
+            BEGIN
+                IF nextval('retry_calls') % 2 = 1 THEN
+                    RAISE EXCEPTION 'serialization failure' USING ERRCODE = '40001';
+                END IF;
+                RETURN 0;
+            END
+            $$ LANGUAGE plpgsql VOLATILE
+            """
+        )
+    query = Application.builder().select().where(Application.columns.id != RawSql("fail_every_other()")).limit(1)
+
+    events = []
+    listener = add_retry_listener(events.append)
+    try:
+        await query.retry(RetryPolicy(base_delay=0)).run()
+        assert [(event.operation, event.attempt) for event in events] == [("query", 1)]
+
+        # Queries on a scoped connection aren't retried
+        with pytest.raises(asyncpg.SerializationError):
+            async with connection_scope() as conn:
+                await conn.execute("ALTER SEQUENCE retry_calls RESTART")
+                await query.retry(RetryPolicy(base_delay=0)).run()
+
+        calls = []
+
+        async def transfer(conn):
+            calls.append(conn)
+            await conn.execute("SET TRANSACTION ISOLATION LEVEL SERIALIZABLE")
+            return await conn.fetchval("SELECT fail_every_other()")
+
+        events.clear()
+        async with get_connection() as conn:
+            await conn.execute("ALTER SEQUENCE retry_calls RESTART")
+        assert await retry_transaction(transfer, RetryPolicy(base_delay=0)) == 0
+        assert len(calls) == 2 and [event.operation for event in events] == ["transaction"]
+
+        # An empty budget raises right away
+        with pytest.raises(asyncpg.SerializationError):
+            await retry_transaction(transfer, RetryPolicy(base_delay=0, budget=0, budget_size=0))
+    finally:
+        remove_retry_listener(listener)
+
+
+async def test_retryable_errors():
+    policy = RetryPolicy()
+    # Lost connections and failed connects
+    assert policy.is_retryable(asyncpg.ConnectionDoesNotExistError())
+    assert policy.is_retryable(asyncpg.InterfaceError("cannot perform operation: connection is closed"))
+    assert policy.is_retryable(ConnectionResetError())
+    assert policy.is_retryable(OSError("Multiple exceptions: [Errno 111] Connect call failed"))
+    assert policy.is_retryable(asyncpg.SerializationError())
+    # Errors that repeat
+    assert not policy.is_retryable(asyncpg.exceptions._base.DataError("invalid input for query argument $1"))
+    assert not policy.is_retryable(asyncpg.UniqueViolationError())
+    assert not policy.is_retryable(TimeoutError())
+    assert not policy.is_retryable(Exception())
+
+
+async def test_pgbouncer_mode(db):
+    await close()
+    configure(DATABASE_URL + DB_NAME, pgbouncer=True, statement_timeout=0.1)
+    try:
+        assert actual_orm.connection.pool_options.max_size == 50
+        async with connection_scope() as conn:
+            await Application.query(Application.columns.external_id == "pgbouncer")
+            # No named statements are left on the server connection and the
+            # timeout isn't a startup parameter
+            assert await conn.fetchval("SELECT count(*) FROM pg_prepared_statements") == 0
+            assert await conn.fetchval("SHOW statement_timeout") == "0"
+        with pytest.raises(TimeoutError):
+            await Application.query(sleeping(1))
+        await Application.query(sleeping(0.2), timeout=5)
+    finally:
+        await close()
+        configure(DATABASE_URL + DB_NAME)
+
+
 async def test_upsert(db):
     external_id = "test_upsert"
     created_app = await Application.upsert(
@@ -160,3 +708,283 @@ async def test_upsert(db):
 
     assert updated_app.id == created_app.id
     assert updated_app.title == "Updated"
+
+
+async def test_start_transaction_binds_connection(db):
+    try:
+        async with start_transaction():
+            app = await Application.create({"external_id": "rolled_back", "title": "title"})
+            await Application.delete(Application.columns.id == app.id)
+            app = await Application.create({"external_id": "rolled_back", "title": "title"})
+            raise ValueError("rollback")
+    except ValueError:
+        pass
+
+    assert await Application.get(Application.columns.id == app.id) == None
+
+
+async def test_nested_transaction_uses_savepoint(db):
+    async with start_transaction():
+        outer = await Application.create({"external_id": "outer", "title": "title"})
+        try:
+            async with start_transaction():
+                inner = await Application.create({"external_id": "inner", "title": "title"})
+                raise ValueError("rollback savepoint")
+        except ValueError:
+            pass
+
+    assert await Application.get(Application.columns.id == outer.id) != None
+    assert await Application.get(Application.columns.id == inner.id) == None
+
+
+async def test_connection_scope_reuses_connection(db):
+    async with connection_scope() as conn:
+        async with get_connection() as inner_conn:
+            assert inner_conn is conn
+        async with connection_scope() as nested_conn:
+            assert nested_conn is conn
+
+
+async def test_pool_options_and_connect_hooks(db):
+    await close()
+    connected = []
+
+    @on_connect
+    async def record_connection(conn):
+        connected.append(conn)
+
+    warm_hook = prepare_on_connect(
+        Application.builder().select().where(Application.columns.id == 0)
+    )
+    configure(
+        DATABASE_URL + DB_NAME,
+        PoolOptions(min_size=1, max_size=2, server_settings={"application_name": "actual_orm_test"}),
+    )
+    try:
+        async with get_connection() as conn:
+            assert len(connected) >= 1
+            assert await conn.fetchval("SHOW application_name") == "actual_orm_test"
+        pool = await actual_orm.connection.get_or_create_pool()
+        assert pool.get_max_size() == 2
+    finally:
+        actual_orm.connection.connection_init_hooks.remove(record_connection)
+        actual_orm.connection.connection_init_hooks.remove(warm_hook)
+        await close()
+        configure(DATABASE_URL + DB_NAME)
+
+
+async def test_replica_routing(db):
+    await close()
+    configure(
+        primary=DATABASE_URL + DB_NAME,
+        replicas=[DATABASE_URL + DB_NAME + "?application_name=replica"],
+        selection=ReplicaSelection.LEAST_BUSY,
+        read_your_writes=60,
+    )
+    try:
+        async with get_connection(readonly=True) as conn:
+            assert await conn.fetchval("SHOW application_name") == "replica"
+        async with start_transaction():
+            async with get_connection(readonly=True) as conn:
+                assert await conn.fetchval("SHOW application_name") != "replica"
+
+        app = await Application.create({"external_id": "replica", "title": "title"})
+        async with get_connection(readonly=True) as conn:
+            assert await conn.fetchval("SHOW application_name") != "replica"
+        assert await Application.get(Application.columns.id == app.id) != None
+    finally:
+        await close()
+        configure(DATABASE_URL + DB_NAME)
+
+
+async def test_replica_in_lists(db):
+    app = await Application.create({"external_id": "replica in list", "title": "title"})
+    await close()
+    # Read-only like a hot standby, temp tables can't be created on it
+    configure(
+        primary=DATABASE_URL + DB_NAME,
+        replicas=[DATABASE_URL + DB_NAME + "?default_transaction_read_only=on"],
+        in_list_size=3,
+    )
+    try:
+        condition = Application.columns.id.in_([app.id, -1, -2, -3])
+        assert await Application.query(condition) == [app]
+        [apps] = await batch(Application.builder().select().where(condition))
+        assert apps == [app]
+    finally:
+        await close()
+        configure(DATABASE_URL + DB_NAME)
+
+
+async def test_pool_metrics(db):
+    events = []
+    listener = add_pool_listener(events.append)
+    configure_pool_metrics(leak_after=0.01)
+    try:
+        async with get_connection():
+            assert pool_stats()["primary"].in_use >= 1
+            await asyncio.sleep(0.05)
+        await Application.query(limit=1)
+
+        stats = pool_stats()["primary"]
+        assert stats.acquires >= 2
+        assert stats.acquire_wait.count == stats.acquires
+        assert stats.leaks >= 1
+        assert [event.type for event in events][:4] == ["acquire", "leak", "release", "acquire"]
+        assert events[1].stack != None
+
+        # A failing listener is logged instead of failing the query
+        def fail(event):
+            raise Exception("listener failed")
+
+        add_pool_listener(fail)
+        try:
+            await Application.query(limit=1)
+        finally:
+            remove_pool_listener(fail)
+    finally:
+        configure_pool_metrics(enable=False)
+        remove_pool_listener(listener)
+
+
+async def test_query_listener(db):
+    events = []
+    listener = add_query_listener(events.append)
+    try:
+        await Application.create({"external_id": "listener", "title": "title"})
+        await Application.create_many(
+            [{"external_id": "listener", "title": "one"}, {"external_id": "listener", "title": "two"}]
+        )
+        apps = await Application.query(Application.columns.external_id == "listener")
+    finally:
+        remove_query_listener(listener)
+
+    assert len(events) == 3
+    assert events[0].fingerprint == events[1].fingerprint
+    assert events[2].query_type == "select"
+    assert events[2].model == "Application"
+    assert events[2].table == "applications"
+    assert events[2].row_count == len(apps) == 3
+    assert events[2].execute_time > 0
+
+    # A failing listener is logged, the write it saw has committed
+    def fail(event):
+        raise Exception("listener failed")
+
+    add_query_listener(fail)
+    try:
+        app = await Application.create({"external_id": "listener", "title": "failing"})
+    finally:
+        remove_query_listener(fail)
+    assert await Application.get(Application.columns.id == app.id) != None
+
+
+async def test_slow_query_log(db, tmp_path):
+    slow_queries = []
+    slow_query_log = SlowQueryLog(
+        threshold=0,
+        redact=["title"],
+        explain=True,
+        path=str(tmp_path / "slow.log"),
+        callback=slow_queries.append,
+    )
+    listener = add_query_listener(slow_query_log)
+    try:
+        async with start_transaction():
+            await Application.query(
+                AndCondition(
+                    Application.columns.title == "secret",
+                    Application.columns.title.between("secret a", "secret z"),
+                ),
+                limit=1,
+            )
+        await slow_query_log.flush()
+    finally:
+        remove_query_listener(listener)
+
+    [slow_query] = slow_queries
+    assert slow_query.parameters == ["<redacted>", "<redacted>", "<redacted>", 1]
+    assert slow_query.plan[0]["Plan"]["Node Type"] == "Limit"
+    assert slow_query.plan[0]["Plan"]["Plans"][0]["Relation Name"] == "applications"
+    assert "test_stuff.py" in slow_query.call_site
+
+    [line] = (tmp_path / "slow.log").read_text().splitlines()
+    assert json.loads(line)["fingerprint"] == slow_query.event.fingerprint
+
+    # Values inside expressions are named after the column they're written
+    # into or compared to
+    slow_queries.clear()
+    slow_query_log.explain = False
+    listener = add_query_listener(slow_query_log)
+    try:
+        await Application.update(
+            {"title": coalesce("secret", Application.columns.title)},
+            Application.columns.title == coalesce("secret", Application.columns.external_id),
+        )
+    finally:
+        remove_query_listener(listener)
+
+    [slow_query] = slow_queries
+    assert "secret" not in slow_query.parameters
+    assert "<redacted>" in slow_query.parameters
+
+
+async def test_explain_flags_missed_indexes(db):
+    app = await Application.create({"external_id": "explain", "title": "title"})
+    api_key = await ApiKey.create(
+        {"key": "00000000-0000-0000-0000-000000000001", "active": True, "application_id": app.id}
+    )
+    builder = ApiKey.builder().select().where(ApiKey.columns.key == api_key.key)
+
+    async with start_transaction() as conn:
+        await conn.execute("SET LOCAL enable_seqscan = off")
+        plan = await builder.explain(analyze=True)
+    assert plan.missed_indexes == []
+    assert plan.sequential_scans == []
+    assert plan.root.actual_rows == 1
+    assert plan.root.shared_hit_blocks != None
+
+    async with start_transaction() as conn:
+        await conn.execute("SET LOCAL enable_indexscan = off")
+        await conn.execute("SET LOCAL enable_bitmapscan = off")
+        plan = await builder.explain()
+    [missed] = plan.missed_indexes
+    assert missed.table == "api_keys"
+    assert missed.columns == ["key"]
+    assert ["key"] in missed.indexes
+    assert ["key", "created_at"] in missed.indexes
+    assert plan.root.actual_rows == None
+
+
+async def test_foreign_key_indexes():
+    api_keys = get_model_schema(ApiKey)
+    assert [index.columns for index in api_keys.indexes if index.type == "index"] == [["key", "created_at"], ["application_id"]]
+    assert ["application_id"] in ApiKey._get_index_columns()
+
+    # application_id already leads the (application_id, external_id) unique index
+    owners = get_model_schema(Owner)
+    assert ["application_id"] not in [index.columns for index in owners.indexes if index.type == "index"]
+
+
+async def test_index_advisor():
+    api_keys = get_model_schema(ApiKey)
+    redundant = find_redundant_indexes([api_keys])
+    assert [finding.columns for finding in redundant] == [["key", "created_at"], ["created_at", "key"]]
+
+    workload = [
+        WorkloadQuery(
+            sql="SELECT api_keys.id FROM api_keys WHERE (api_keys.application_id = $1) ORDER BY api_keys.created_at desc LIMIT $2",
+            calls=10,
+            total_time=1.0,
+        ),
+        WorkloadQuery(sql="SELECT api_keys.id FROM api_keys WHERE api_keys.application_id = ANY($1)", calls=5, total_time=0.5),
+        WorkloadQuery(sql="SELECT api_keys.id FROM api_keys WHERE (api_keys.key = $1)", calls=100, total_time=1.0),
+    ]
+    # The foreign key index on application_id already serves these queries
+    assert suggest_indexes(workload, [api_keys]) == []
+
+    api_keys.indexes = [index for index in api_keys.indexes if index.columns != ["application_id"]]
+    [suggestion] = suggest_indexes(workload, [api_keys])
+    assert suggestion.table == "api_keys"
+    assert suggestion.columns == ["application_id", "created_at"]
+    assert suggestion.calls == 15